@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from brickrake import color
+from brickrake import io
+from brickrake import pricing
+from brickrake import scraper
+
+
+def timed(f, repeat):
+  """Best wall clock time of `repeat` calls to f"""
+  best = float('inf')
+  for i in range(repeat):
+    start = time.time()
+    f()
+    best = min(best, time.time() - start)
+  return best
+
+
+def report(name, seconds, baseline=None):
+  if baseline is None:
+    print '%-40s %10.4fs' % (name, seconds)
+  else:
+    print '%-40s %10.4fs %8.1fx' % (name, seconds, baseline / seconds)
+
+
+def color_distance(args):
+  """Compare ways of computing distances between all pairs of colors"""
+  labs = [c['lab'] for c in color.colors().values()]
+  print 'Distance matrix for %d colors' % len(labs)
+
+  def one_at_a_time():
+    return [[color.distance(c1, c2) for c2 in labs] for c1 in labs]
+
+  def vectorized():
+    return color.distances(labs, labs)
+
+  baseline = timed(one_at_a_time, args.repeat)
+  report('color.distance (colormath)', baseline)
+  report('color.distances (numpy)', timed(vectorized, args.repeat), baseline)
+
+
+def load_price_guide(args):
+  """Compare loading a price guide from JSON and from binary"""
+  folder = tempfile.mkdtemp()
+  try:
+    binary_path = os.path.join(folder, 'price_guide.bin')
+    with open(binary_path, 'wb') as f:
+      io.save_price_guide_binary(f, io.load_price_guide(open(args.price_guide)))
+    print 'Price guide: %.1f MB as JSON, %.1f MB in binary' % (
+        os.path.getsize(args.price_guide) / (1024.0 * 1024.0),
+        os.path.getsize(binary_path) / (1024.0 * 1024.0))
+
+    def from_json():
+      return pricing.PriceGuide.from_lots(io.load_price_guide(open(args.price_guide)))
+
+    def from_binary():
+      return io.load_price_guide_binary(binary_path)
+
+    baseline = timed(from_json, args.repeat)
+    report('JSON', baseline)
+    report('binary', timed(from_binary, args.repeat), baseline)
+  finally:
+    shutil.rmtree(folder)
+
+
+def parse_price_guide(args):
+  """Compare ways of extracting lots from catalogPG.asp pages"""
+  pages = []
+  for path in args.pages:
+    if os.path.isdir(path):
+      pages.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                   if name.endswith('.html'))
+    else:
+      pages.append(path)
+  pages = [open(path).read() for path in pages]
+  print 'Parsing %d pages, %.1f MB' % (len(pages), sum(len(p) for p in pages) / (1024.0 * 1024.0))
+
+  def parse(parser):
+    return lambda: [scraper.parse_price_guide(html, parser) for html in pages]
+
+  baseline = timed(parse('bs4'), args.repeat)
+  report('bs4 (%.0f pages/s)' % (len(pages) / baseline), baseline)
+  seconds = timed(parse('fast'), args.repeat)
+  report('fast (%.0f pages/s)' % (len(pages) / seconds), seconds, baseline)
+
+
+# modules that are slow to import and only needed by some subcommands
+HEAVY_MODULES = ['bs4', 'numpy', 'pandas', 'colormath', 'gurobipy', 'sqlite3']
+
+# what each subcommand imports before doing any work
+STARTUP = [
+  ('brickrake.color', 'import brickrake.color'),
+  ('brickrake.io', 'import brickrake.io'),
+  ('brickrake.minimizer', 'import brickrake.minimizer'),
+  ('brickrake.scraper', 'import brickrake.scraper'),
+  ('bin/main.py', 'import imp; imp.load_source("main", %r)'
+                  % os.path.join(os.path.dirname(__file__), 'main.py')),
+]
+
+
+def startup(args):
+  """Time how long it takes to import each module in a fresh interpreter"""
+  script = ("import sys, time; start = time.time(); %s; "
+            "print time.time() - start; "
+            "print ','.join(m for m in %r if m in sys.modules)")
+
+  print '%-40s %10s   %s' % ('Module', 'Time', 'Heavy imports')
+  for (name, statement) in STARTUP:
+    def run():
+      output = subprocess.check_output(
+          [sys.executable, '-c', script % (statement, HEAVY_MODULES)])
+      return output.splitlines()
+
+    runs = [run() for i in range(args.repeat)]
+    seconds = min(float(r[0]) for r in runs)
+    heavy = runs[0][1] if len(runs[0]) > 1 else ''
+    print '%-40s %9.4fs   %s' % (name, seconds, heavy)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser("Brickrake benchmarks")
+  parser.add_argument('--repeat', default=3, type=int,
+      help='Number of times to run each benchmark. The best time is reported.')
+  subparsers = parser.add_subparsers()
+
+  parser_cd = subparsers.add_parser("color_distance",
+      help="Distance between every pair of colors")
+  parser_cd.set_defaults(func=color_distance)
+
+  parser_pg = subparsers.add_parser("load_price_guide",
+      help="Time spent loading a price guide in each format")
+  parser_pg.add_argument('--price-guide', required=True,
+      help='JSON price guide output by "brickrake price_guide"')
+  parser_pg.set_defaults(func=load_price_guide)
+
+  parser_pp = subparsers.add_parser("parse_price_guide",
+      help="Pages per second extracted from price guide pages by each parser")
+  parser_pp.add_argument('pages', nargs='*',
+      default=[os.path.join(os.path.dirname(scraper.__file__), 'tests', 'data', 'catalog_pg')],
+      help='Saved catalogPG.asp pages, or folders of them')
+  parser_pp.set_defaults(func=parse_price_guide)
+
+  parser_st = subparsers.add_parser("startup",
+      help="Time spent importing modules when the command line tool starts")
+  parser_st.set_defaults(func=startup)
+
+  args = parser.parse_args()
+  args.func(args)
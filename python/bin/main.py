@@ -5,179 +5,636 @@ import os
 import sys
 import traceback
 
+# only modules needed by every subcommand are imported here. The rest are
+# imported by the subcommands that use them to keep start up fast.
 from brickrake import color
 from brickrake import io
-from brickrake import minimizer
-from brickrake import scraper
 from brickrake import utils
+from brickrake import web
+
+
+def use_cache(args):
+  """Set up the HTTP response cache, if requested"""
+  if args.cache is None:
+    return None
+  from brickrake import cache
+
+  max_bytes = int(args.cache_size * 1024 * 1024) if args.cache_size is not None else None
+  response_cache = cache.ResponseCache(args.cache, ttl=args.cache_ttl, max_bytes=max_bytes)
+  web.set_cache(response_cache)
+  return response_cache
+
+
+def print_cache_stats(response_cache):
+  if response_cache is not None:
+    stats = response_cache.stats()
+    print 'Cache: %d hits | %d misses | %d evictions | %d pages (%.1f MB)' % (
+        stats['hits'], stats['misses'], stats['evictions'], stats['entries'],
+        stats['bytes'] / (1024.0 * 1024.0))
+
+
+def add_store_arguments(parser):
+  parser.add_argument('--source-country', default=None,
+      help='limit search to stores in a particular country')
+  parser.add_argument('--target-country', default=None,
+      help='limit search to stores that ship to a particular country')
+  parser.add_argument('--feedback', default=0, type=int,
+      help='limit search to stores with enough feedback')
+  parser.add_argument('--exclude', default=None,
+      help='Force exclusion of the following comma-separated store IDs')
+
+
+def add_solver_arguments(parser):
+  parser.add_argument('--solver', default='gurobi',
+      choices=['gurobi', 'cbc'],
+      help=('Integer Linear Program solver. cbc requires PuLP and no license. ' +
+        'Only used if algorithm=ilp'))
+  parser.add_argument('--no-presolve', dest='presolve', action='store_false',
+      help='Don\'t remove lots and stores that can\'t be part of the best solution')
+  parser.add_argument('--gap', default=0.01, type=float,
+      help=('Stop once the solution is provably within this fraction of the best. ' +
+        'Only used if algorithm=ilp'))
+  parser.add_argument('--time-limit', default=None, type=float,
+      help=('Maximum number of seconds to spend improving a solution. The best ' +
+        'solution found so far is used. Only used if algorithm=ilp or greedy+ls'))
+  parser.add_argument('--max-iterations', default=1000, type=int,
+      help='Maximum number of changes to the stores used. Only used if algorithm=greedy+ls')
+  parser.add_argument('--lower-bound', default='simple',
+      choices=['none', 'simple', 'lp'],
+      help=('How to bound the cost of the best solution, to report how far ' +
+        'from it the solution found could be. lp is tighter but requires scipy'))
+
+
+def load_wanted_parts(path):
+  """Load a parts list, or merge all parts lists in a folder into one"""
+  if not os.path.isdir(path):
+    return io.load_parts_list(path)
+
+  from multiprocessing import Pool
+
+  paths = [os.path.join(path, name) for name in sorted(os.listdir(path))
+           if os.path.splitext(name)[1].lower() in ['.bsx', '.xml']]
+  print 'Merging %d parts lists' % len(paths)
+  pool = Pool()
+  try:
+    return io.load_parts_lists(paths, pool)
+  finally:
+    pool.close()
+
+
+def add_fetch_arguments(parser):
+  parser.add_argument('--max-connections', default=4, type=int,
+      help='Maximum number of simultaneous requests to BrickLink')
+  parser.add_argument('--min-interval', default=0.0, type=float,
+      help='Minimum number of seconds between requests to BrickLink')
+  parser.add_argument('--timeout', default=30.0, type=float,
+      help='Seconds to wait for BrickLink to respond before giving up on a request')
+  parser.add_argument('--retries', default=3, type=int,
+      help='Number of times to retry a request that fails')
+  parser.add_argument('--backoff', default=1.0, type=float,
+      help='Seconds to wait before retrying a request. Doubles after every failure.')
+
+
+def use_fetch_arguments(args):
+  """Set up politeness limits and retries for requests to BrickLink"""
+  web.set_session(args.timeout)
+  web.set_throttle(args.max_connections, args.min_interval)
+  web.set_retries(args.retries, args.backoff)
+
+
+def print_fetch_stats():
+  stats = web.SESSION.stats()
+  print 'Fetched %d pages | %.1f MB transferred (%.1f MB uncompressed) | %d connections reused' % (
+      stats['requests'], stats['bytes_received'] / (1024.0 * 1024.0),
+      stats['bytes_decoded'] / (1024.0 * 1024.0), stats['reused'])
+
+
+def add_cache_arguments(parser):
+  parser.add_argument('--cache', default=None,
+      help='SQLite file to cache downloaded pages in')
+  parser.add_argument('--cache-ttl', default=24 * 60 * 60, type=float,
+      help='Number of seconds a cached page stays fresh')
+  parser.add_argument('--cache-size', default=None, type=float,
+      help='Maximum size of the cache in MB')
 
 
 def price_guide(args):
   """Scrape pricing information for all wanted parts"""
+  from multiprocessing.pool import ThreadPool
+
+  from brickrake import scraper
+
   # load in wanted parts
-  if args.parts_list.endswith(".bsx"):
-    wanted_parts = io.load_bsx(open(args.parts_list))
-  else:
-    wanted_parts = io.load_xml(open(args.parts_list))
+  wanted_parts = load_wanted_parts(args.parts_list)
   print 'Loaded %d different parts' % len(wanted_parts)
 
   # get prices for available parts
-  fmt = "{i:4d} {status:10s} {name:60s} {color:30s} {quantity:5d}"
-  print "{i:4s} {status:10s} {name:60s} {color:30s} {quantity:5s}" \
-      .format(i="i", status="status", name="name", color="color", quantity="qty")
-  print (4 + 1 + 10 + 1 + 60 + 1 + 30 + 1 + 5) * "-"
-
-  # load half-complete price guide if available
+  fmt = "{i:4d} {status:10s} {name:60s} {color:30s} {quantity:5d} {colors:>11s}"
+  print "{i:4s} {status:10s} {name:60s} {color:30s} {quantity:5s} {colors:>11s}" \
+      .format(i="i", status="status", name="name", color="color", quantity="qty",
+              colors="used/tried")
+  print (4 + 1 + 10 + 1 + 60 + 1 + 30 + 1 + 5 + 1 + 11) * "-"
+
+  # load half-complete price guide if available. Only totals are kept in
+  # memory, as the price guide may be large.
+  found = {}
   if args.resume:
-    old_parts = io.load_price_guide(open(args.resume))
-    old_parts = utils.groupby(old_parts, lambda x: (x['item_id'], x['wanted_color_id']))
-  else:
-    old_parts = {}
-
-  available_parts = []
-
-  # for each wanted lot
-  for (i, item) in enumerate(wanted_parts):
+    for lot in io.iter_price_guide(open(args.resume)):
+      key = (lot['item_id'], lot['wanted_color_id'])
+      quantity, colors = found.get(key, (0, set()))
+      colors.add(lot['color_id'])
+      found[key] = (quantity + lot['quantity_available'], colors)
+  done = set(
+      (item['ItemID'], item['ColorID']) for item in wanted_parts
+      if found.get((item['ItemID'], item['ColorID']), (0, None))[0] >= item['Qty']
+  )
+
+  # lots are appended to the output as soon as each wanted lot is done, so a
+  # crash only loses the wanted lots in flight. Lots already found are copied
+  # over first. The output may be the same file as the one being resumed.
+  if args.resume:
+    partial_path = args.output + '.partial'
+    with open(partial_path, 'wb') as partial:
+      io.append_price_guide(partial, (
+          lot for lot in io.iter_price_guide(open(args.resume))
+          if (lot['item_id'], lot['wanted_color_id']) in done
+      ))
+    os.rename(partial_path, args.output)
+  output = open(args.output, 'ab' if args.resume else 'wb')
+
+  # fetch several lots at once. Colors for a single lot are also fetched in
+  # batches, by default of the same size. The number of simultaneous requests
+  # to BrickLink is capped separately.
+  color_batch = args.color_batch if args.color_batch is not None else args.workers
+  use_fetch_arguments(args)
+  response_cache = use_cache(args)
+  item_pool = ThreadPool(args.workers)
+  fetch_pool = ThreadPool(max(args.workers, color_batch))
+
+  def search(item):
+    """Find available inventory for a single wanted lot"""
     # skip this item if we already have enough
-    matching = old_parts.get( (item['ItemID'], item['ColorID']), [])
-    quantity_found = sum(e['quantity_available'] for e in matching)
-
-    print fmt.format(i=i, status="seeking", name=item['ItemName'], color=item['ColorName'], quantity=item['Qty'])
-
-    if quantity_found >= item['Qty']:
-      colors = [color.name(id) for id in set(e['color_id'] for e in matching)]
-      print fmt.format(i=i, status="passing", name=item['ItemName'], color=",".join(colors), quantity=quantity_found)
-      available_parts.extend(matching)
+    if (item['ItemID'], item['ColorID']) in done:
+      return ('passing', None, None)
     else:
       try:
         # fetch price data for this item in the closest available color
-        new = scraper.price_guide(item, max_cost_quantile=args.max_price_quantile)
-        available_parts.extend(new)
-
-        # print out status message
-        total_quantity = sum(e['quantity_available'] for e in new)
-        colors = [color.name(id) for id in set(e['color_id'] for e in new)]
-        print fmt.format(i=i, status="found", name=item['ItemName'], color=",".join(colors), quantity=total_quantity)
-
-        if total_quantity < item['Qty']:
-          print 'WARNING! Couldn\'t find enough parts!'
-
+        stats = {}
+        new = scraper.price_guide(item, max_cost_quantile=args.max_price_quantile,
+                                  pool=fetch_pool, batch_size=color_batch,
+                                  parser=args.parser, max_distance=args.max_color_distance,
+                                  max_colors=args.max_colors, stats=stats)
+        return ('found', new, stats)
       except Exception as e:
-        print 'Catastrophic Failure! :('
-        traceback.print_exc()
+        return ('failed', traceback.format_exc(), None)
 
-  # save price data
-  io.save_price_guide(open(args.output, 'w'), available_parts)
+  # for each wanted lot, in the order of the parts list
+  searches = item_pool.imap(search, wanted_parts)
+  total_stats = {'tried': 0, 'used': 0}
+  for (i, item) in enumerate(wanted_parts):
+    print fmt.format(i=i, status="seeking", name=item['ItemName'], color=item['ColorName'],
+                     quantity=item['Qty'], colors='')
+
+    status, new, stats = searches.next()
+    if status == 'failed':
+      print 'Catastrophic Failure! :('
+      print new,
+      continue
+
+    if status == 'passing':
+      total_quantity, color_ids = found[(item['ItemID'], item['ColorID'])]
+      tried = '-'
+    else:
+      io.append_price_guide(output, new)
+      total_quantity = sum(e['quantity_available'] for e in new)
+      color_ids = set(e['color_id'] for e in new)
+      tried = '%d/%d' % (stats['used'], stats['tried'])
+      for k in total_stats:
+        total_stats[k] += stats[k]
+
+    # print out status message
+    colors = [color.name(id) for id in color_ids]
+    print fmt.format(i=i, status=status, name=item['ItemName'], color=",".join(colors),
+                     quantity=total_quantity, colors=tried)
+
+    if total_quantity < item['Qty']:
+      print 'WARNING! Couldn\'t find enough parts!'
+
+  item_pool.close()
+  fetch_pool.close()
+  output.close()
+  print 'Searched %d colors | found inventory in %d' % (total_stats['tried'], total_stats['used'])
+  print_fetch_stats()
+  print_cache_stats(response_cache)
+
+
+def load_price_guide(path):
+  """Load a JSON or binary price guide as a pricing.PriceGuide"""
+  from brickrake import pricing
+
+  if io.is_binary_price_guide(path):
+    guide = io.load_price_guide_binary(path)
+  else:
+    guide = pricing.PriceGuide.from_lots(io.load_price_guide(open(path)))
+  print 'Loaded %d available lots from %d stores' % (len(guide), len(guide.store_ids))
+  return guide
+
+
+def select_stores(args, store_metadata):
+  """Choose which stores to get parts from"""
+  allowed_stores = [s for s in store_metadata if s['minimum_buy'] is not None]
+  if len(allowed_stores) < len(store_metadata):
+    print 'Skipping %d stores with a minimum buy in a foreign currency' % (
+        len(store_metadata) - len(allowed_stores),)
+  if args.source_country is not None:
+    print 'Only allowing stores from %s' % (args.source_country,)
+    allowed_stores = filter(lambda x: x['country_name'] == args.source_country, allowed_stores)
+
+  if args.target_country is not None:
+    print 'Only allowing stores that ship to %s' % (args.target_country,)
+    allowed_stores = [s for s in allowed_stores
+                      if args.target_country in s['ships']
+                      or (len(s['ships']) == 1 and s['ships'][0] == 'All Countries WorldWide')]
+
+  if args.feedback is not None and args.feedback > 0:
+    print 'Only allowing stores with feedback >= %d' % (args.feedback,)
+    allowed_stores = filter(lambda x: x['feedback'] >= args.feedback, allowed_stores)
+
+  if args.exclude is not None:
+    excludes = set(args.exclude.strip().split(","))
+    excludes = map(lambda x: int(x), excludes)
+    print 'Forcing exclusion of: %s' % (excludes,)
+    allowed_stores = filter(lambda x: not (x['store_id'] in excludes), allowed_stores)
+
+  return allowed_stores
+
+
+def print_presolve_report(report):
+  print ('Presolve removed %d lots and %d stores ' +
+         '(%d unwanted lots, %d overpriced lots, %d stores below minimum buy, ' +
+         '%d dominated stores)') % (
+      report['lots_removed'], report['stores_removed'],
+      report['unwanted_lots'], report['excess_lots'],
+      len(report['unreachable_minimum_buy']), len(report['dominated_stores']))
+
+
+def save_solution_atomically(path, solution):
+  """Save a solution so that path always has a complete solution in it"""
+  with open(path + '.tmp', 'w') as f:
+    io.save_solution(f, solution)
+  os.rename(path + '.tmp', path)
+
+
+def incumbent_saver(path):
+  """A callback for minimizer.ilp that prints and saves every new best solution"""
+  def save(solution, info):
+    bound = '%.2f' % info['bound'] if info['bound'] is not None else '?'
+    print 'Incumbent: $%.2f | bound: $%s | n_stores: %d | elapsed: %.1fs' % (
+        info['objective'], bound, len(solution['store_ids']), info['elapsed'])
+    save_solution_atomically(path, solution)
+  return save
 
 
 def minimize(args):
   """Minimize the cost of a purchase"""
+  from brickrake import minimizer
+
   ################# Loading ##################################
   # load in wanted parts lists
-  if args.parts_list.endswith(".bsx"):
-    wanted_parts = io.load_bsx(open(args.parts_list))
-  else:
-    wanted_parts = io.load_xml(open(args.parts_list))
+  wanted_parts = load_wanted_parts(args.parts_list)
   print 'Loaded %d different parts' % len(wanted_parts)
 
-  # load in pricing data
-  available_parts = io.load_price_guide(open(args.price_guide))
-  n_available = len(available_parts)
-  n_stores = len(set(e['store_id'] for e in available_parts))
-  print 'Loaded %d available lots from %d stores' % (n_available, n_stores)
+  # load in pricing data. It's converted to arrays once and shared by every
+  # step below.
+  available_parts = load_price_guide(args.price_guide)
+
+  # what changed since the solution being warm started from was found
+  delta = None
+  if args.warm_start is not None and args.previous_price_guide is not None:
+    from brickrake import pricing
+
+    print 'Comparing with the previous price guide'
+    delta = pricing.diff(load_price_guide(args.previous_price_guide), available_parts)
+    print '%d lots added or increased, %d lots removed or decreased' % (
+        len(delta['added']), len(delta['removed']))
 
   # load in store metadata
+  allowed_stores = None
   if args.store_list is not None:
     store_metadata = io.load_store_metadata(open(args.store_list))
     print 'Loaded metadata for %d stores' % len(store_metadata)
 
     ################# Filtering Stores #########################
     # select which stores to get parts from
-    allowed_stores = list(store_metadata)
-    if args.source_country is not None:
-      print 'Only allowing stores from %s' % (args.source_country,)
-      allowed_stores = filter(lambda x: x['country_name'] == args.source_country, allowed_stores)
-
-    if args.target_country is not None:
-      print 'Only allowing stores that ship to %s' % (args.target_country,)
-      allowed_stores = [s for s in allowed_stores
-                        if args.target_country in s['ships']
-                        or (len(s['ships']) == 1 and s['ships'][0] == 'All Countries WorldWide')]
-
-    if args.feedback is not None and args.feedback > 0:
-      print 'Only allowing stores with feedback >= %d' % (args.feedback,)
-      allowed_stores = filter(lambda x: x['feedback'] >= args.feedback, allowed_stores)
-
-    if args.exclude is not None:
-      excludes = set(args.exclude.strip().split(","))
-      excludes = map(lambda x: int(x), excludes)
-      print 'Forcing exclusion of: %s' % (excludes,)
-      allowed_stores = filter(lambda x: not (x['store_id'] in excludes), allowed_stores)
+    allowed_stores = select_stores(args, store_metadata)
 
     store_ids = map(lambda x: x['store_id'], allowed_stores)
     store_ids = list(set(store_ids))
     print 'Using %d stores' % len(store_ids)
 
-    available_parts = filter(lambda x: x['store_id'] in store_ids, available_parts)
+    available_parts = available_parts.select_stores(store_ids)
 
-    solution = minimizer.greedy(wanted_parts, available_parts)[0]
-    if not minimizer.is_valid_solution(wanted_parts, solution['allocation']):
+    solutions = minimizer.greedy(wanted_parts, available_parts)
+    if len(solutions) == 0 or not minimizer.is_valid_solution(wanted_parts, solutions[0]['allocation']):
       print ("You're too restrictive. There's no way to buy what " +
              "you want with these stores")
       sys.exit(1)
 
+  ################# Presolve #################################
+  if args.presolve:
+    available_parts, allowed_stores, report = minimizer.presolve(
+        wanted_parts, available_parts, allowed_stores)
+    print_presolve_report(report)
+
+  ################# Lower Bound ##############################
+  bound = None
+  if args.lower_bound != 'none':
+    bound = minimizer.lower_bound(wanted_parts, available_parts, allowed_stores,
+        shipping_cost=args.shipping_cost, method=args.lower_bound)
+    print 'Lower bound on cost with shipping: $%.2f' % bound
+
   ################# Minimization #############################
-  if args.algorithm in ['ilp', 'greedy']:
-    if args.algorithm == 'ilp':
+  if args.algorithm == 'ilp' and args.n_solutions > 1:
+    ### Integer Linear Programming, several sets of stores ###
+    solutions = minimizer.ilp_alternatives(
+        wanted_parts,
+        available_parts,
+        allowed_stores,
+        args.n_solutions,
+        shipping_cost=args.shipping_cost,
+        solver=args.solver,
+        gap=args.gap,
+        time_limit=args.time_limit
+    )
+    print 'Found %d different sets of stores' % len(solutions)
+
+    # save them like brute-force does, by number of stores
+    by_n_stores = utils.groupby(solutions, lambda x: len(x['store_ids']))
+    for (k, group) in sorted(by_n_stores.iteritems()):
+      best = min(s['cost'] for s in group)
+      print '%d stores: $%.2f%s' % (k, best, gap_report(best + args.shipping_cost * k, bound))
+      save_solutions(os.path.join(args.output, str(k)), group)
+
+  elif args.algorithm in ['ilp', 'greedy', 'greedy+ls']:
+    if args.algorithm == 'ilp' and args.warm_start is not None:
+      ### Integer Linear Programming, starting from a previous solution ###
+      solution = first_solution(minimizer.reoptimize(
+          wanted_parts,
+          io.load_solution(open(args.warm_start)),
+          available_parts,
+          allowed_stores,
+          delta=delta,
+          shipping_cost=args.shipping_cost,
+          solver=args.solver,
+          gap=args.gap,
+          time_limit=args.time_limit,
+          callback=incumbent_saver(args.output + ".json")
+      ))
+      print 'Warm start: %s' % (solution['warm_start'],)
+      assert minimizer.is_valid_solution(wanted_parts, solution['allocation'], allowed_stores)
+    elif args.algorithm == 'ilp':
       ### Integer Linear Programming ###
-      solution = minimizer.gurobi(
+      solution = first_solution(minimizer.ilp(
           wanted_parts,
           available_parts,
           allowed_stores,
-          shipping_cost=args.shipping_cost
-      )[0]
+          shipping_cost=args.shipping_cost,
+          solver=args.solver,
+          gap=args.gap,
+          time_limit=args.time_limit,
+          callback=incumbent_saver(args.output + ".json")
+      ))
       assert minimizer.is_valid_solution(wanted_parts, solution['allocation'], allowed_stores)
     elif args.algorithm == 'greedy':
       ### Greedy Set Cover ###
-      solution = minimizer.greedy(wanted_parts, available_parts)[0]
+      solution = first_solution(minimizer.greedy(wanted_parts, available_parts))
+    elif args.algorithm == 'greedy+ls':
+      ### Greedy Set Cover, improved by Local Search ###
+      solution = first_solution(minimizer.local_search(
+          wanted_parts,
+          available_parts,
+          allowed_stores,
+          shipping_cost=args.shipping_cost,
+          max_iterations=args.max_iterations,
+          time_limit=args.time_limit
+      ))
+      stats = solution['local_search']
+      print 'Local search: %d moves in %.2fs | cost with shipping: $%.2f -> $%.2f' % (
+          stats['iterations'], stats['seconds'], stats['initial_cost'], stats['final_cost'])
 
     # check and save
-    io.save_solution(open(args.output + ".json", 'w'), solution)
+    save_solution_atomically(args.output + ".json", solution)
 
     # print outs
     stores = set(e['store_id'] for e in solution['allocation'])
     cost = solution['cost']
     unsatisified =  minimizer.unsatisified(wanted_parts, solution['allocation'])
-    print 'Total cost: $%.2f | n_stores: %d | remaining lots: %d' % (cost, len(stores), len(unsatisified))
+    print 'Total cost: $%.2f | n_stores: %d | remaining lots: %d%s' % (
+        cost, len(stores), len(unsatisified),
+        gap_report(cost + args.shipping_cost * len(stores), bound))
+    if 'timing' in solution:
+      timing = solution['timing']
+      print 'Build: %.2fs | Solve: %.2fs | Extract: %.2fs' % (timing['build'], timing['solve'], timing['extract'])
 
 
   elif args.algorithm == 'brute-force':
     # for each possible number of stores
     for k in range(1, args.max_n_stores):
       # find all possible solutions using k stores
-      solutions = minimizer.brute_force(wanted_parts, available_parts, k)
-      solutions = list(sorted(solutions, key=lambda x: x['cost']))
-      solutions = solutions[0:10]
-
-      # save output
-      output_folder = os.path.join(args.output, str(k))
-      try:
-        os.makedirs(output_folder)
-      except OSError:
-        pass
-
-      for (i, solution) in enumerate(solutions):
-        output_path = os.path.join(output_folder, "%02d.json" % i)
-        with open(output_path, 'w') as f:
-          io.save_solution(f, solution)
-
-      # print outs
-      if len(solutions) > 0:
-        print '%8s %40s' % ('Cost', 'Store IDs')
-        for sol in solutions:
-          print '$%7.2f %40s' % (sol['cost'], ",".join(str(s) for s in sol['store_ids']))
-      else:
+      solutions = minimizer.brute_force(wanted_parts, available_parts, k, n_best=10)
+      save_solutions(os.path.join(args.output, str(k)), solutions)
+      if len(solutions) == 0:
         print "No solutions using %d stores" % k
+      else:
+        best = min(s['cost'] for s in solutions)
+        print "%d stores: $%.2f%s" % (k, best, gap_report(best + args.shipping_cost * k, bound))
+
+
+def gap_report(total, bound):
+  """Describe how far a solution costing `total` with shipping could be
+  from the best one"""
+  if bound is None or total <= 0:
+    return ''
+  return ' | lower bound: $%.2f (gap %.1f%%)' % (bound, 100.0 * max(total - bound, 0) / total)
+
+
+def first_solution(solutions):
+  """The best of the solutions found, or exit if there are none"""
+  if len(solutions) == 0:
+    print ("No solution found. If a time limit was set, it may be too short " +
+           "to find one.")
+    sys.exit(1)
+  return solutions[0]
+
+
+def save_solutions(output_folder, solutions):
+  """Save solutions, cheapest first, as <output_folder>/<NN>.json"""
+  solutions = list(sorted(solutions, key=lambda x: x['cost']))
+
+  # save output
+  try:
+    os.makedirs(output_folder)
+  except OSError:
+    pass
+
+  for (i, solution) in enumerate(solutions):
+    output_path = os.path.join(output_folder, "%02d.json" % i)
+    with open(output_path, 'w') as f:
+      io.save_solution(f, solution)
+
+  # print outs
+  if len(solutions) > 0:
+    print '%8s %40s' % ('Cost', 'Store IDs')
+    for sol in solutions:
+      print '$%7.2f %40s' % (sol['cost'], ",".join(str(s) for s in sol['store_ids']))
+
+
+# state shared with the processes solving parts lists in batch(). They're
+# forked after it's set, so the price guide is shared rather than copied.
+BATCH = {}
+
+
+def batch(args):
+  """Minimize the cost of many purchases using the same price guide"""
+  import json
+  from multiprocessing import Pool
+
+  ################# Loading ##################################
+  if os.path.isdir(args.parts_lists[0]) and len(args.parts_lists) == 1:
+    folder = args.parts_lists[0]
+    paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+             if os.path.splitext(name)[1].lower() in ['.bsx', '.xml']]
+  else:
+    paths = args.parts_lists
+
+  # solutions are named after their parts list, so names must be unique
+  names = utils.groupby(paths, batch_name)
+  duplicates = [group for group in names.values() if len(group) > 1]
+  if len(duplicates) > 0:
+    print 'Parts lists must have different file names. These clash:'
+    for group in duplicates:
+      print '  ' + ', '.join(group)
+    sys.exit(1)
+  print 'Minimizing %d parts lists' % len(paths)
+
+  available_parts = load_price_guide(args.price_guide)
+
+  allowed_stores = None
+  if args.store_list is not None:
+    store_metadata = io.load_store_metadata(open(args.store_list))
+    print 'Loaded metadata for %d stores' % len(store_metadata)
+    allowed_stores = select_stores(args, store_metadata)
+    print 'Using %d stores' % len(allowed_stores)
+    available_parts = available_parts.select_stores(s['store_id'] for s in allowed_stores)
+
+  try:
+    os.makedirs(args.output)
+  except OSError:
+    pass
+
+  ################# Minimization #############################
+  BATCH.update(args=args, price_guide=available_parts, stores=allowed_stores)
+  pool = Pool(args.workers)
+  rows = []
+  try:
+    for row in pool.imap(batch_minimize, paths):
+      if row['error'] is not None:
+        print 'Failed to minimize %s' % (row['name'],)
+        print row['error'],
+      rows.append(row)
+  finally:
+    pool.close()
+
+  with open(os.path.join(args.output, 'summary.json'), 'w') as f:
+    json.dump(rows, f, indent=2)
+
+  fmt = "{name:30s} {parts:>6} {cost:>10} {stores:>7} {missing:>8} {time:>8}"
+  print fmt.format(name='parts list', parts='parts', cost='cost',
+                   stores='stores', missing='missing', time='time')
+  print (30 + 1 + 6 + 1 + 10 + 1 + 7 + 1 + 8 + 1 + 8) * "-"
+  for row in rows:
+    if row['error'] is not None:
+      print fmt.format(name=row['name'], parts='', cost='failed', stores='', missing='', time='')
+    else:
+      print fmt.format(name=row['name'], parts=row['n_parts'], cost='$%.2f' % row['cost'],
+                       stores=row['n_stores'], missing=row['n_missing'],
+                       time='%.1fs' % row['seconds'])
+
+
+def batch_name(path):
+  """Name a parts list's solution is saved under. The extension is kept, so
+  a.bsx and a.xml don't overwrite each other."""
+  return os.path.basename(path)
+
+
+def batch_minimize(path):
+  """Minimize the cost of one parts list for batch()"""
+  import time
+
+  from brickrake import minimizer
+
+  args = BATCH['args']
+  name = batch_name(path)
+  row = {'name': name, 'path': path, 'error': None}
+  start = time.time()
+  try:
+    wanted_parts = io.load_parts_list(path)
+    available_parts = BATCH['price_guide']
+    allowed_stores = BATCH['stores']
+    if args.presolve:
+      available_parts, allowed_stores, report = minimizer.presolve(
+          wanted_parts, available_parts, allowed_stores)
+
+    if args.algorithm == 'ilp':
+      solutions = minimizer.ilp(
+          wanted_parts,
+          available_parts,
+          allowed_stores,
+          shipping_cost=args.shipping_cost,
+          solver=args.solver,
+          gap=args.gap,
+          time_limit=args.time_limit
+      )
+    elif args.algorithm == 'greedy+ls':
+      solutions = minimizer.local_search(
+          wanted_parts,
+          available_parts,
+          allowed_stores,
+          shipping_cost=args.shipping_cost,
+          max_iterations=args.max_iterations,
+          time_limit=args.time_limit
+      )
+    else:
+      solutions = minimizer.greedy(wanted_parts, available_parts)
+
+    if len(solutions) == 0:
+      raise ValueError("There's no way to buy everything in %s" % (path,))
+    solution = solutions[0]
+    with open(os.path.join(args.output, name + '.json'), 'w') as f:
+      io.save_solution(f, solution)
+
+    row.update(
+      n_parts=len(wanted_parts),
+      cost=solution['cost'],
+      n_stores=len(set(e['store_id'] for e in solution['allocation'])),
+      n_missing=len(minimizer.unsatisified(wanted_parts, solution['allocation'])),
+    )
+  except Exception:
+    row['error'] = traceback.format_exc()
+  row['seconds'] = time.time() - start
+  return row
+
+
+def convert(args):
+  """Convert a price guide between JSON and binary"""
+  if io.is_binary_price_guide(args.input):
+    guide = io.load_price_guide_binary(args.input)
+    with open(args.output, 'w') as f:
+      io.save_price_guide(f, guide.lots())
+  else:
+    with open(args.output, 'wb') as f:
+      io.save_price_guide_binary(f, io.load_price_guide(open(args.input)))
+  print 'Converted %s to %s' % (args.input, args.output)
 
 
 def wanted_list(args):
@@ -190,8 +647,66 @@ def wanted_list(args):
 
 def store_list(args):
   """Get metadata for stores"""
-  info = scraper.store_info(country=args.country)
-  io.save_store_metadata(open(args.output, 'w'), info)
+  from multiprocessing.pool import ThreadPool
+
+  from brickrake import scraper
+
+  # stores are appended to the output as soon as they're done, so a crash
+  # only loses the stores in flight. Stores already found are copied over
+  # first. The output may be the same file as the one being resumed.
+  done = set()
+  if args.update:
+    stores = io.load_store_metadata(open(args.update))
+    print 'Updating %d stores' % len(stores)
+  elif args.resume:
+    stores = io.load_store_metadata(open(args.resume))
+    done = set(s['seller_name'] for s in stores)
+    print 'Resuming from %d stores' % len(stores)
+
+    partial_path = args.output + '.partial'
+    with open(partial_path, 'wb') as partial:
+      io.append_store_metadata(partial, stores)
+    os.rename(partial_path, args.output)
+  use_fetch_arguments(args)
+  response_cache = use_cache(args)
+  pool = ThreadPool(args.workers) if args.workers > 1 else None
+
+  if args.update:
+    # the updated list is only moved into place once it's complete, as stores
+    # that are kept are written last
+    output_path = args.output + '.partial'
+    output = open(output_path, 'wb')
+    entries = scraper.update_store_info(stores, args.ttl, country=args.country, pool=pool)
+  else:
+    output_path = args.output
+    output = open(args.output, 'ab' if args.resume else 'wb')
+    entries = ((entry, True) for entry in
+               scraper.iter_store_info(country=args.country, pool=pool, skip=done))
+
+  n_fetched = 0
+  n_kept = 0
+  written = set()
+  for (entry, fetched) in entries:
+    io.append_store_metadata(output, [entry])
+    written.add(entry['seller_name'])
+    if not fetched:
+      n_kept += 1
+      continue
+    minimum_buy = ('$%.2f' % entry['minimum_buy'] if entry['minimum_buy'] is not None
+                   else 'foreign currency')
+    print '%5d %-30s %-20s feedback: %5d | minimum buy: %s' % (
+        n_fetched, entry['seller_name'], entry['country_name'], entry['feedback'], minimum_buy)
+    n_fetched += 1
+
+  if pool is not None:
+    pool.close()
+  output.close()
+  if args.update:
+    os.rename(output_path, args.output)
+    print 'Fetched %d stores | kept %d | dropped %d' % (
+        n_fetched, n_kept, len([s for s in stores if s['seller_name'] not in written]))
+  print_fetch_stats()
+  print_cache_stats(response_cache)
 
 
 if __name__ == '__main__':
@@ -201,12 +716,28 @@ if __name__ == '__main__':
   parser_pg = subparsers.add_parser("price_guide",
       help="Download pricing information from BrickLink")
   parser_pg.add_argument('--parts-list', required=True,
-      help='BSX file containing desired parts')
+      help='BSX or BrickLink XML file containing desired parts, or a folder of them')
   parser_pg.add_argument('--max-price-quantile', default=1.0, type=float,
       help=('Ignore lots that cost more than this quantile' +
             ' of the price distribution per item'))
   parser_pg.add_argument('--resume', default=None,
-      help='Resume a previously run price_guide search')
+      help='Resume a previously run price_guide search. May be the same file as --output.')
+  parser_pg.add_argument('--workers', default=1, type=int,
+      help='Number of wanted lots (and colors per lot) to fetch at once')
+  parser_pg.add_argument('--color-batch', default=None, type=int,
+      help=('Number of colors of a lot to fetch at once. Colors are fetched ' +
+            'speculatively, so larger batches are faster but may fetch colors ' +
+            'that aren\'t needed. Defaults to --workers'))
+  parser_pg.add_argument('--max-color-distance', default=None, type=float,
+      help=('Don\'t consider colors further than this from the wanted color, ' +
+            'as measured by CIEDE2000'))
+  parser_pg.add_argument('--max-colors', default=None, type=int,
+      help='Maximum number of colors to consider per lot, including the wanted color')
+  add_fetch_arguments(parser_pg)
+  parser_pg.add_argument('--parser', default='fast', choices=['fast', 'bs4'],
+      help=('How to read price guide pages. bs4 uses Beautiful Soup, which is ' +
+            'slower but more forgiving of unusual pages'))
+  add_cache_arguments(parser_pg)
   parser_pg.add_argument('--output', required=True,
       help='Location to save price guide for wanted list')
   parser_pg.set_defaults(func=price_guide)
@@ -214,32 +745,68 @@ if __name__ == '__main__':
   parser_mn = subparsers.add_parser("minimize",
       help="Find a small set of vendors to buy parts from")
   parser_mn.add_argument('--parts-list', required=True,
-      help='BSX file containing desired parts')
+      help='BSX or BrickLink XML file containing desired parts, or a folder of them')
   parser_mn.add_argument('--price-guide', required=True,
-      help='Pricing information output by "brickrake price_guide"')
+      help='Pricing information output by "brickrake price_guide" or "brickrake convert"')
   parser_mn.add_argument('--store-list', default=None,
       help='JSON file containing store metadata. If using algorithm=ilp, this is required')
-  parser_mn.add_argument('--source-country', default=None,
-      help='limit search to stores in a particular country')
-  parser_mn.add_argument('--target-country', default=None,
-      help='limit search to stores that ship to a particular country')
-  parser_mn.add_argument('--feedback', default=0, type=int,
-      help='limit search to stores with enough feedback')
-  parser_mn.add_argument('--exclude', default=None,
-      help='Force exclusion of the following comma-separated store IDs')
+  add_store_arguments(parser_mn)
   parser_mn.add_argument('--algorithm', default='ilp',
-      choices=['ilp', 'brute-force', 'greedy'],
+      choices=['ilp', 'brute-force', 'greedy', 'greedy+ls'],
       help='Algorithm used to select vendors')
+  add_solver_arguments(parser_mn)
   parser_mn.add_argument('--max-n-stores', default=5, type=int,
       help=('Maximum number of different stores in a proposed solution.' +
         'Only used if algorithm=brute-force.'))
   parser_mn.add_argument('--shipping-cost', default=10.0, type=float,
       help=('Estimated cost of shipping per store. ' + 
+        'Only used if algorithm=ilp or greedy+ls'))
+  parser_mn.add_argument('--n-solutions', default=1, type=int,
+      help=('Number of solutions to find, each using a different set of stores. ' +
+        'If more than 1, they\'re saved cheapest first like algorithm=brute-force does. ' +
+        'They\'re only guaranteed to be the cheapest sets of stores with --gap 0 ' +
+        'and no --time-limit. ' +
+        'Only used if algorithm=ilp'))
+  parser_mn.add_argument('--warm-start', default=None,
+      help=('Solution found by a previous run to start from. ' +
         'Only used if algorithm=ilp'))
+  parser_mn.add_argument('--previous-price-guide', default=None,
+      help=('Price guide the --warm-start solution was found with. If only ' +
+        'lots it didn\'t use disappeared, that solution is kept without solving.'))
   parser_mn.add_argument('--output', required=True,
       help='Directory to save purchase recommendations')
   parser_mn.set_defaults(func=minimize)
 
+  parser_bt = subparsers.add_parser("batch",
+      help="Find vendors for many parts lists using the same price guide")
+  parser_bt.add_argument('--parts-lists', required=True, nargs='+',
+      help='BSX or BrickLink XML files containing desired parts, or a folder of them')
+  parser_bt.add_argument('--price-guide', required=True,
+      help='Pricing information covering every parts list')
+  parser_bt.add_argument('--store-list', default=None,
+      help='JSON file containing store metadata. If using algorithm=ilp, this is required')
+  add_store_arguments(parser_bt)
+  parser_bt.add_argument('--algorithm', default='ilp',
+      choices=['ilp', 'greedy', 'greedy+ls'],
+      help='Algorithm used to select vendors')
+  add_solver_arguments(parser_bt)
+  parser_bt.add_argument('--shipping-cost', default=10.0, type=float,
+      help=('Estimated cost of shipping per store. ' +
+        'Only used if algorithm=ilp or greedy+ls'))
+  parser_bt.add_argument('--workers', default=None, type=int,
+      help='Number of parts lists to minimize at once. Defaults to the number of CPUs.')
+  parser_bt.add_argument('--output', required=True,
+      help='Directory to save a purchase recommendation per parts list and a summary in')
+  parser_bt.set_defaults(func=batch)
+
+  parser_cv = subparsers.add_parser("convert",
+      help="Convert a price guide from JSON to binary, or from binary to JSON")
+  parser_cv.add_argument("--input", required=True,
+      help='Price guide to convert. Its format is detected automatically.')
+  parser_cv.add_argument("--output", required=True,
+      help='Location to save converted price guide')
+  parser_cv.set_defaults(func=convert)
+
   parser_wl = subparsers.add_parser("wanted_list",
       help="Create a BrickLink Wanted List")
   parser_wl.add_argument("--recommendation", required=True,
@@ -254,8 +821,19 @@ if __name__ == '__main__':
       help="Download metadata about stores")
   parser_st.add_argument("--country", default=None,
       help="Only gather metadata for stores from this country")
+  parser_st.add_argument('--resume', default=None,
+      help='Resume a previously run stores search. May be the same file as --output.')
+  parser_st.add_argument('--update', default=None,
+      help=('Refresh a previous stores search, only fetching stores that are new ' +
+            'or older than --ttl and dropping stores that are gone. May be the same file as --output.'))
+  parser_st.add_argument('--ttl', default=7 * 24 * 60 * 60, type=float,
+      help='Number of seconds metadata for a store stays fresh. Only used with --update')
+  parser_st.add_argument('--workers', default=1, type=int,
+      help='Number of pages to fetch at once')
+  add_fetch_arguments(parser_st)
+  add_cache_arguments(parser_st)
   parser_st.add_argument("--output", required=True,
-      help="Folder to create BrickLink Wanted List XML in")
+      help="File to save store metadata in, one store per line")
   parser_st.set_defaults(func=store_list)
 
   args = parser.parse_args()
@@ -0,0 +1,145 @@
+"""
+A persistent cache for web pages fetched from bricklink.com
+"""
+import sqlite3
+import threading
+import time
+import urllib
+import urlparse
+
+
+def normalize_url(url):
+  """Canonical form of a URL, so equivalent URLs share a cache entry"""
+  parsed = urlparse.urlparse(url)
+  params = sorted(urlparse.parse_qsl(parsed.query, keep_blank_values=True))
+  return urlparse.urlunparse((
+    parsed.scheme.lower(),
+    parsed.netloc.lower(),
+    parsed.path or '/',
+    parsed.params,
+    urllib.urlencode(params),
+    ''
+  ))
+
+
+class ResponseCache(object):
+  """Page contents keyed by URL, stored in a SQLite database
+
+  Parameters
+  ----------
+  path : str
+      file to store the cache in. Created if it doesn't exist.
+  ttl : float or None
+      number of seconds a page stays fresh. None means forever.
+  max_bytes : int or None
+      maximum total size of cached pages. When exceeded, the least recently
+      used pages are evicted. None means no limit.
+  """
+
+  def __init__(self, path, ttl=None, max_bytes=None):
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute(
+        "CREATE TABLE IF NOT EXISTS pages ("
+        " url TEXT PRIMARY KEY,"
+        " content BLOB,"
+        " size INTEGER,"
+        " fetched REAL,"
+        " accessed INTEGER)")
+    self._db.execute(
+        "CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)")
+    self._db.commit()
+    self._size, self._clock = self._db.execute(
+        "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(accessed), 0) FROM pages"
+    ).fetchone()
+
+  def get(self, url):
+    """Get the contents of a page, or None if it isn't cached or is stale"""
+    url = normalize_url(url)
+    now = time.time()
+    with self._lock:
+      row = self._db.execute(
+          "SELECT content, size, fetched FROM pages WHERE url = ?",
+          (url,)).fetchone()
+
+      if row is None:
+        self.misses += 1
+        return None
+
+      content, size, fetched = row
+      if self.ttl is not None and now - fetched >= self.ttl:
+        # too old to trust
+        self._delete(url, size)
+        self._db.commit()
+        self.misses += 1
+        return None
+
+      self._db.execute("UPDATE pages SET accessed = ? WHERE url = ?",
+                       (self._tick(), url))
+      self._db.commit()
+      self.hits += 1
+      return str(content)
+
+  def put(self, url, content):
+    """Save the contents of a page"""
+    url = normalize_url(url)
+    now = time.time()
+    with self._lock:
+      row = self._db.execute(
+          "SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+      if row is not None:
+        self._delete(url, row[0])
+
+      self._db.execute(
+          "INSERT INTO pages (url, content, size, fetched, accessed)"
+          " VALUES (?, ?, ?, ?, ?)",
+          (url, sqlite3.Binary(content), len(content), now, self._tick()))
+      self._size += len(content)
+      self._evict()
+      self._db.commit()
+
+  def stats(self):
+    """Counters describing how well the cache is doing"""
+    with self._lock:
+      entries = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'entries': entries,
+        'bytes': self._size,
+      }
+
+  def close(self):
+    with self._lock:
+      self._db.close()
+
+  def _tick(self):
+    # pages are ordered by when they were last used, not by wall clock time
+    self._clock += 1
+    return self._clock
+
+  def _delete(self, url, size):
+    self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+    self._size -= size
+
+  def _evict(self):
+    # drop least recently used pages until the cache fits
+    if self.max_bytes is None:
+      return
+    while self._size > self.max_bytes:
+      rows = self._db.execute(
+          "SELECT url, size FROM pages ORDER BY accessed LIMIT 64").fetchall()
+      if len(rows) == 0:
+        break
+      for (url, size) in rows:
+        if self._size <= self.max_bytes:
+          break
+        self._delete(url, size)
+        self.evictions += 1
@@ -1,43 +1,205 @@
 """
 Functions for finding similar colors
 """
+import bisect
+import hashlib
 import json
 import math
 import os
 
-from colormath.color_objects import LabColor
-from colormath.color_diff import delta_e_cie2000
+DATA_FOLDER = os.path.join(os.path.split(__file__)[0], 'data')
 
 # mapping from ColorID to Lab color space. Made using colors extracted from
 # http://www.bricklink.com/catalogColors.asp and code from
 # http://www.cse.unr.edu/~quiroz/inc/colortransforms.py
-COLORS = dict(
-    (int(k), v) for (k, v)
-    in json.load(open(os.path.split(__file__)[0] + '/data/colors.json')).iteritems()
-)
+COLORS_PATH = os.path.join(DATA_FOLDER, 'colors.json')
+_COLORS = None
 
+# for every color, all other colors sorted by distance. Built from colors.json
+# by build_index(). Regenerate it with `python -m brickrake.color` whenever
+# colors.json or the distance function changes.
+INDEX_PATH = os.path.join(DATA_FOLDER, 'color_index.json')
+INDEX_VERSION = 2
+_INDEX = None
 
-def similar_to(color_id):
+
+def similar_to(color_id, k=None, max_distance=None):
   """Get a list of similar colors, by color id"""
+  return [id for (id, d) in neighbors(color_id, k, max_distance)]
+
+
+def neighbors(color_id, k=None, max_distance=None):
+  """Get (color id, distance) pairs for the colors closest to a color
+
+  Parameters
+  ----------
+  color_id : int
+      color to find neighbors of. The color itself is always first.
+  k : int or None
+      maximum number of colors to return
+  max_distance : float or None
+      ignore colors further away than this
+  """
   if color_id == 0:
     color_id = 9  # light grey
 
-  color = COLORS[color_id]
-  distances = sorted(
-      (distance(color2['lab'], color['lab']), id)
-      for (id, color2) in COLORS.items()
-  )
-  return [e[1] for e in distances]
+  ids, distances = index()[color_id]
+  n = len(ids)
+  if k is not None:
+    n = min(n, k)
+  if max_distance is not None:
+    n = min(n, bisect.bisect_right(distances, max_distance))
+  return zip(ids[:n], distances[:n])
 
 
 def distance(color1, color2):
-  """Color distance as defined by CIE76 (L2 norm)"""
+  """Color distance as defined by CIEDE2000"""
+  from colormath.color_objects import LabColor
+  from colormath.color_diff import delta_e_cie2000
+
   return delta_e_cie2000(LabColor(*color1), LabColor(*color2))
 
 
+def distances(labs1, labs2):
+  """Color distance as defined by CIEDE2000 between every pair of colors
+
+  Computes the same thing as distance() for many colors at once, following
+  the formulation used by colormath.
+
+  Parameters
+  ----------
+  labs1 : array-like of shape [n, 3]
+      colors in Lab color space
+  labs2 : array-like of shape [m, 3]
+      colors in Lab color space
+
+  Returns
+  -------
+  numpy array of shape [n, m], where entry [i, j] is the distance between
+  labs1[i] and labs2[j]
+  """
+  import numpy as np
+
+  labs1 = np.asarray(labs1, dtype=float).reshape(-1, 1, 3)
+  labs2 = np.asarray(labs2, dtype=float).reshape(1, -1, 3)
+  L1, a1, b1 = labs1[:, :, 0], labs1[:, :, 1], labs1[:, :, 2]
+  L2, a2, b2 = labs2[:, :, 0], labs2[:, :, 1], labs2[:, :, 2]
+
+  avg_Lp = (L1 + L2) / 2.0
+
+  avg_C = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2.0
+  G = 0.5 * (1 - np.sqrt(avg_C ** 7 / (avg_C ** 7 + 25.0 ** 7)))
+
+  a1p = (1.0 + G) * a1
+  a2p = (1.0 + G) * a2
+  C1p = np.hypot(a1p, b1)
+  C2p = np.hypot(a2p, b2)
+  avg_Cp = (C1p + C2p) / 2.0
+
+  h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+  h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+  avg_Hp = ((np.fabs(h1p - h2p) > 180) * 360 + h1p + h2p) / 2.0
+
+  T = (1 - 0.17 * np.cos(np.radians(avg_Hp - 30))
+         + 0.24 * np.cos(np.radians(2 * avg_Hp))
+         + 0.32 * np.cos(np.radians(3 * avg_Hp + 6))
+         - 0.20 * np.cos(np.radians(4 * avg_Hp - 63)))
+
+  delta_hp = h2p - h1p
+  delta_hp = delta_hp + (np.fabs(delta_hp) > 180) * 360 - (h2p > h1p) * 720
+
+  delta_Lp = L2 - L1
+  delta_Cp = C2p - C1p
+  delta_Hp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(delta_hp) / 2.0)
+
+  S_L = 1 + 0.015 * (avg_Lp - 50) ** 2 / np.sqrt(20 + (avg_Lp - 50) ** 2)
+  S_C = 1 + 0.045 * avg_Cp
+  S_H = 1 + 0.015 * avg_Cp * T
+
+  delta_ro = 30 * np.exp(-((avg_Hp - 275) / 25) ** 2)
+  R_C = np.sqrt(avg_Cp ** 7 / (avg_Cp ** 7 + 25.0 ** 7))
+  R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+  return np.sqrt(
+      (delta_Lp / S_L) ** 2
+      + (delta_Cp / S_C) ** 2
+      + (delta_Hp / S_H) ** 2
+      + R_T * (delta_Cp / S_C) * (delta_Hp / S_H)
+  )
+
+
 def name(color_id):
   """Get name of a color"""
   try:
-    return COLORS[color_id]['name']
+    return colors()[color_id]['name']
   except KeyError:
     return str(color_id)
+
+################################################################################
+
+def colors():
+  """Get the mapping from ColorID to name and Lab color, loading it if necessary"""
+  global _COLORS
+  if _COLORS is None:
+    with open(COLORS_PATH) as f:
+      _COLORS = dict( (int(k), v) for (k, v) in json.load(f).iteritems() )
+  return _COLORS
+
+
+def index():
+  """Get the nearest neighbor index, loading or building it if necessary"""
+  global _INDEX
+  if _INDEX is None:
+    checksum = colors_checksum()
+    try:
+      with open(INDEX_PATH) as f:
+        saved = json.load(f)
+    except IOError:
+      saved = None
+
+    if (saved is not None and saved['version'] == INDEX_VERSION
+        and saved['colors'] == checksum):
+      neighbor_lists = saved['neighbors']
+    else:
+      # index is out of date. Build it from scratch (slow).
+      neighbor_lists = build_index()
+
+    _INDEX = dict(
+        (int(id), ([e[0] for e in lst], [e[1] for e in lst]))
+        for (id, lst) in neighbor_lists.iteritems()
+    )
+  return _INDEX
+
+
+def build_index():
+  """Sort all colors by distance to each color"""
+  ids = list(sorted(colors().keys()))
+  labs = [colors()[id]['lab'] for id in ids]
+  matrix = distances(labs, labs)
+
+  result = {}
+  for (i, id) in enumerate(ids):
+    # the color itself comes first, even if other colors are identical to it
+    row = sorted(zip(matrix[i].tolist(), ids), key=lambda (d, id2): (id2 != id, d, id2))
+    result[id] = [(id2, round(d, 4)) for (d, id2) in row]
+  return result
+
+
+def save_index(f):
+  """Save the nearest neighbor index for the current colors.json"""
+  json.dump({
+    'version': INDEX_VERSION,
+    'colors': colors_checksum(),
+    'neighbors': build_index()
+  }, f, sort_keys=True)
+
+
+def colors_checksum():
+  """Fingerprint of colors.json, used to tell if the index is out of date"""
+  with open(COLORS_PATH, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+if __name__ == '__main__':
+  with open(INDEX_PATH, 'w') as f:
+    save_index(f)
@@ -3,10 +3,11 @@ Functions for loading/saving data
 """
 import json
 import os
-import xml.etree.ElementTree as etree
-
-import numpy as np
-import pandas
+import struct
+try:
+  import xml.etree.cElementTree as etree
+except ImportError:
+  import xml.etree.ElementTree as etree
 
 import color
 import utils
@@ -36,49 +37,83 @@ def load_bsx(f):
   ----------
   f : file-like object
       file containing XML contents"""
-  root = etree.parse(f)
-  items = []
-  for item in root.findall('.//Item'):
-    item_dict = {}
-    for child in item.getchildren():
-      tag = child.tag
-      value = CONVERT.get(child.tag, lambda x: x)(child.text)
-      item_dict[tag] = value
-    items.append(item_dict)
-
-  # sometimes there are multiple wanted lots with the same ItemID and ColorID.
-  # Consolidate them together now.
-  by_item = utils.groupby(items, lambda x: (x['ItemID'], x['ColorID']))
-  result = []
-  for ((item_id, color_id), same) in by_item.iteritems():
-    prototype = same[0]
-    prototype['Qty'] = sum(e['Qty'] for e in same)
-    result.append(prototype)
-  return result
+  return consolidate(iter_items(f, 'Item', {}))
 
 
 def load_xml(f):
   """Parse a BrickLink XML file"""
-  root = etree.parse(f)
   items = []
-  for item in root.findall('.//ITEM'):
-    item_dict = {}
-    for child in item.getchildren():
-      tag = TRANSLATIONS.get(child.tag, child.tag)
-      value = CONVERT.get(tag, lambda x: x)(child.text)
-      item_dict[tag] = value
+  for item_dict in iter_items(f, 'ITEM', TRANSLATIONS):
     item_dict['ItemName'] = item_dict['ItemID']
     item_dict['ColorName'] = color.name(item_dict['ColorID'])
     items.append(item_dict)
+  return consolidate(items)
+
+
+def load_parts_list(path):
+  """Load a wanted parts list from a BSX or BrickLink XML file"""
+  with open(path, 'rb') as f:
+    if os.path.splitext(path)[1].lower() == ".bsx":
+      return load_bsx(f)
+    else:
+      return load_xml(f)
+
+
+def load_parts_lists(paths, pool=None):
+  """Load several wanted parts lists and merge them into one
+
+  Parameters
+  ----------
+  paths : [str]
+      BSX or BrickLink XML files
+  pool : multiprocessing.Pool or None
+      if given, files are parsed in parallel by this pool
+  """
+  lists = (pool.map if pool is not None else map)(load_parts_list, paths)
+  return consolidate(utils.flatten(lists))
+
+
+def iter_items(f, tag, translations):
+  """Iterate over items in an XML file without building the whole tree
+
+  Parameters
+  ----------
+  f : file-like object
+      file containing XML contents
+  tag : str
+      tag of elements describing a single item
+  translations : dict
+      new names for the item's fields
+  """
+  for (event, element) in etree.iterparse(f):
+    if element.tag != tag:
+      continue
+    item_dict = {}
+    for child in element:
+      name = translations.get(child.tag, child.tag)
+      item_dict[name] = CONVERT.get(name, lambda x: x)(child.text)
+    yield item_dict
+
+    # free up the item's children now that they've been read
+    element.clear()
+
+
+def consolidate(items):
+  """Merge wanted lots with the same ItemID and ColorID
 
-  # sometimes there are multiple wanted lots with the same ItemID and ColorID.
-  # Consolidate them together now.
-  by_item = utils.groupby(items, lambda x: (x['ItemID'], x['ColorID']))
+  Sometimes there are multiple wanted lots with the same ItemID and ColorID.
+  The first of them is kept with the total quantity of all of them, in the
+  order they first appear.
+  """
+  by_item = {}
   result = []
-  for ((item_id, color_id), same) in by_item.iteritems():
-    prototype = same[0]
-    prototype['Qty'] = sum(e['Qty'] for e in same)
-    result.append(prototype)
+  for item in items:
+    key = (item['ItemID'], item['ColorID'])
+    if key in by_item:
+      by_item[key]['Qty'] += item['Qty']
+    else:
+      by_item[key] = item
+      result.append(item)
   return result
 
 
@@ -135,7 +170,42 @@ def save_xml_per_vendor(folder, solution, stores):
 
 def load_price_guide(f):
   """Load pricing output"""
-  return json.load(f)
+  return list(iter_price_guide(f))
+
+
+def iter_price_guide(f):
+  """Iterate over the lots in pricing output without loading all of it
+
+  Handles both a JSON list of lots (as written by save_price_guide) and one
+  lot per line (as written by append_price_guide).
+  """
+  return iter_records(f)
+
+
+def iter_records(f):
+  """Iterate over a JSON list of objects, or one JSON object per line
+
+  In the latter case an unfinished last line, left behind by a crash, is
+  ignored.
+  """
+  first = f.read(1)
+  while first.isspace():
+    first = f.read(1)
+
+  if first == '[':
+    for record in json.loads(first + f.read()):
+      yield record
+    return
+
+  line = first + f.readline()
+  while len(line) > 0:
+    if len(line.strip()) > 0:
+      try:
+        yield json.loads(line)
+      except ValueError:
+        if line.endswith('\n'):
+          raise
+    line = f.readline()
 
 
 def save_price_guide(f, price_guide):
@@ -143,9 +213,132 @@ def save_price_guide(f, price_guide):
   json.dump(price_guide, f, indent=2)
 
 
+def append_price_guide(f, lots):
+  """Append lots to pricing output, one per line
+
+  The lots are on disk when this returns, so at most the lots of the current
+  call are lost if the program dies.
+  """
+  append_records(f, lots)
+
+
+def append_records(f, records):
+  """Append JSON objects to a file, one per line, and wait until they're on disk"""
+  f.writelines(json.dumps(record) + '\n' for record in records)
+  f.flush()
+  os.fsync(f.fileno())
+
+
+# binary price guides start with this, followed by the length of a JSON header
+# as an 8 byte little endian integer, the header itself, and then one column
+# per field of pricing.PriceGuide. Columns are aligned to 8 bytes so they can
+# be memory mapped.
+BINARY_MAGIC = 'BRICKPG1'
+BINARY_VERSION = 2
+BINARY_COLUMNS = [
+  ('store', '<i4'),
+  ('item', '<i4'),
+  ('color_id', '<i4'),
+  ('quantity', '<i8'),
+  ('unit_cost', '<f8'),
+  # indices, so they needn't be rebuilt on every load
+  ('item_lots', '<i8'),
+  ('item_offsets', '<i8'),
+  ('store_lots', '<i8'),
+  ('store_offsets', '<i8'),
+  ('pair_offsets', '<i8'),
+  ('pair_store', '<i4'),
+  ('pair_item', '<i4'),
+  ('pair_quantity', '<i8'),
+  ('store_pair_offsets', '<i8'),
+]
+
+
+def is_binary_price_guide(path):
+  """True if a file was written by save_price_guide_binary"""
+  with open(path, 'rb') as f:
+    return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def load_price_guide_binary(path):
+  """Load a binary price guide as a pricing.PriceGuide. Arrays are memory
+  mapped instead of read, and used as they are."""
+  import numpy as np
+
+  import pricing
+
+  with open(path, 'rb') as f:
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+      raise ValueError('%s is not a binary price guide' % path)
+    (header_size,) = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(header_size))
+  start = (len(BINARY_MAGIC) + 8 + header_size + 7) // 8 * 8
+
+  columns = {}
+  for column in header['columns']:
+    # version 1 files only have lot columns, all n_lots long
+    (name, dtype, offset) = column[:3]
+    length = column[3] if len(column) > 3 else header['n_lots']
+    if length == 0:
+      # empty arrays can't be memory mapped
+      columns[name] = np.zeros(0, dtype=dtype)
+    else:
+      columns[name] = np.memmap(path, dtype=dtype, mode='r',
+                                offset=start + offset, shape=(length,))
+
+  store_ids = header['store_ids']
+  items = [tuple(k) for k in header['items']]
+  if header.get('version', 1) == 1:
+    return pricing.PriceGuide(
+        store_ids, items, columns['store'], columns['item'], columns['color_id'],
+        columns['quantity'], columns['unit_cost']
+    )
+  return pricing.PriceGuide.from_arrays(store_ids, items, columns)
+
+
+def save_price_guide_binary(f, price_guide):
+  """Save a price guide (a pricing.PriceGuide or a list of lots) in binary"""
+  import numpy as np
+
+  import pricing
+
+  guide = pricing.as_price_guide(price_guide)
+  align = lambda n: (n + 7) // 8 * 8
+
+  # column offsets are relative to the first 8 byte boundary after the header
+  columns = []
+  offset = 0
+  for (name, dtype) in BINARY_COLUMNS:
+    data = np.ascontiguousarray(getattr(guide, name), dtype=dtype)
+    columns.append((name, dtype, offset, data))
+    offset = align(offset + data.nbytes)
+
+  header = json.dumps({
+    'version': BINARY_VERSION,
+    'n_lots': len(guide),
+    'store_ids': guide.store_ids,
+    'items': guide.items,
+    'columns': [(name, dtype, offset, len(data)) for (name, dtype, offset, data) in columns],
+  })
+  f.write(BINARY_MAGIC)
+  f.write(struct.pack('<Q', len(header)))
+  f.write(header)
+
+  position = len(BINARY_MAGIC) + 8 + len(header)
+  start = align(position)
+  for (name, dtype, offset, data) in columns:
+    f.write('\0' * (start + offset - position))
+    f.write(data.tostring())
+    position = start + offset + data.nbytes
+
+
 def load_store_metadata(f):
-  """Load metadata associated with stores"""
-  return json.load(f)
+  """Load metadata associated with stores
+
+  Handles both a JSON list (as written by save_store_metadata) and one store
+  per line (as written by append_store_metadata).
+  """
+  return list(iter_records(f))
 
 
 def save_store_metadata(f, metadata):
@@ -153,6 +346,11 @@ def save_store_metadata(f, metadata):
   json.dump(metadata, f, indent=2)
 
 
+def append_store_metadata(f, metadata):
+  """Append metadata for stores to a file, one store per line"""
+  append_records(f, metadata)
+
+
 def load_solution(f):
   """Load a set of buying recommendations"""
   return json.load(f)
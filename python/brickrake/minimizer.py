@@ -1,86 +1,324 @@
 """
 Algorithms for minimizing cost of a purchase
+
+Every algorithm takes the price guide either as a list of lots or as a
+pricing.PriceGuide. Build the latter once when running several algorithms on
+the same price guide.
 """
 import copy
+import heapq
 import itertools
+import time
+
+import numpy as np
 
+import pricing
 import utils
 
 
-def brute_force(wanted_parts, price_guide, k):
-  """Enumerate all possible combinations of k stores"""
-  by_store = utils.groupby(price_guide, lambda x: x['store_id'])
+INFINITY = float('inf')
+
+
+def presolve(wanted_parts, price_guide, stores=None):
+  """Remove lots and stores that can't be part of an optimal solution
+
+  1) lots for parts that aren't wanted
+  2) lots that will never be bought because the same store sells enough of
+     the same part more cheaply
+  3) stores whose entire wanted inventory is worth less than their minimum
+     buy
+  4) stores that are dominated by another store that has no minimum buy and
+     sells enough of everything they sell at a lower or equal price
+
+  Rules 1) and 2) only apply to stores without a minimum buy, as buying extra
+  parts may be the cheapest way to reach it. If `stores` is None, no store has
+  a minimum buy.
+
+  Returns
+  -------
+  (price_guide, stores, report) where report describes what was removed.
+  The price guide is of the same type as the one passed in.
+  """
+  guide = pricing.as_price_guide(price_guide)
+  n_stores = len(guide.store_ids)
+
+  # how much is wanted of each part
+  wanted_qty = np.zeros(len(guide.items), dtype=np.int64)
+  for (k, item) in zip(guide.wanted_items(wanted_parts).tolist(), wanted_parts):
+    if k >= 0:
+      wanted_qty[k] += item['Qty']
 
-  results = []
-  for selected_stores in itertools.combinations(by_store.keys(), k):
-    # get items sold by these stores only
-    inventory = utils.flatten( by_store[s] for s in selected_stores )
-    if covers(wanted_parts, inventory):
+  minimum_buy = np.zeros(n_stores)
+  if stores is not None:
+    for s in stores:
+      i = guide.store_index(s['store_id'])
+      if i >= 0:
+        minimum_buy[i] = s['minimum_buy']
+  free = minimum_buy <= 0.0
+
+  report = {
+    'unwanted_lots': 0,
+    'excess_lots': 0,
+    'unreachable_minimum_buy': [],
+    'dominated_stores': {},
+  }
+  keep = np.ones(len(guide), dtype=bool)
+
+  # 3) stores that can't possibly reach their minimum buy
+  value = np.bincount(guide.store, weights=guide.quantity * guide.unit_cost, minlength=n_stores)
+  unreachable = value < minimum_buy
+  report['unreachable_minimum_buy'] = [guide.store_ids[s] for s in np.flatnonzero(unreachable)]
+  keep &= ~unreachable[guide.store]
+
+  # 1) lots nobody wants
+  unwanted = (wanted_qty[guide.item] == 0) & free[guide.store] & keep
+  report['unwanted_lots'] = int(unwanted.sum())
+  keep &= ~unwanted
+
+  # 2) lots nobody would buy, because the lots before them in the same
+  # (store, part) pair already cover the wanted quantity. Lots are in the same
+  # pairs as guide.store_lots, but the biggest lot wins ties in price.
+  lots = np.lexsort((-guide.quantity, guide.unit_cost, guide.item, guide.store))
+  pair_of_lot = np.repeat(np.arange(len(guide.pair_store)), np.diff(guide.pair_offsets))
+  cumulative = np.cumsum(guide.quantity[lots])
+  before = cumulative - guide.quantity[lots]
+  before -= np.concatenate([[0], cumulative])[guide.pair_offsets[:-1]][pair_of_lot]
+  excess = np.zeros(len(guide), dtype=bool)
+  excess[lots] = before >= wanted_qty[guide.item[lots]]
+  excess &= free[guide.store] & keep
+  report['excess_lots'] = int(excess.sum())
+  keep &= ~excess
+
+  # 4) dominated stores. For each (store, part) pair, find the cheapest price
+  # and how much is sold at each price.
+  kept_lots = lots[keep[lots]]
+  kept_pairs = pair_of_lot[keep[lots]]
+  pair_lots = {}
+  for (p, i) in zip(kept_pairs.tolist(), kept_lots.tolist()):
+    pair_lots.setdefault(p, []).append(i)
+
+  store_pairs = {}   # store -> {part: pair}
+  sellers = {}       # part -> stores
+  for p in sorted(pair_lots.keys()):
+    (s, k) = (int(guide.pair_store[p]), int(guide.pair_item[p]))
+    if wanted_qty[k] > 0:
+      store_pairs.setdefault(s, {})[k] = p
+      sellers.setdefault(k, set()).add(s)
+
+  def enough_at_price(s, k, max_price):
+    # does a store sell the whole wanted quantity at or below max_price?
+    quantity = 0
+    for i in pair_lots[store_pairs[s][k]]:
+      if guide.unit_cost[i] > max_price:
+        break
+      quantity += guide.quantity[i]
+    return quantity >= wanted_qty[k]
+
+  dominated = np.zeros(n_stores, dtype=bool)
+  for s in range(n_stores):
+    inventory = store_pairs.get(s, {})
+    if len(inventory) == 0:
+      continue
+
+    candidates = None
+    for k in inventory:
+      candidates = sellers[k] if candidates is None else candidates & sellers[k]
+    candidates = [o for o in sorted(candidates) if o != s and free[o]]
+
+    for other in candidates:
+      if all(enough_at_price(other, k, guide.unit_cost[pair_lots[p][0]])
+             for (k, p) in inventory.iteritems()):
+        report['dominated_stores'][guide.store_ids[s]] = guide.store_ids[other]
+        dominated[s] = True
+        for k in inventory:
+          sellers[k].discard(s)
+        break
+  keep &= ~dominated[guide.store]
+
+  remaining_stores = set(guide.store_ids[s] for s in np.unique(guide.store[keep]))
+  if stores is not None:
+    stores = [s for s in stores if s['store_id'] in remaining_stores]
+
+  report['lots_removed'] = int((~keep).sum())
+  report['stores_removed'] = n_stores - len(remaining_stores)
+
+  if isinstance(price_guide, pricing.PriceGuide):
+    price_guide = guide.subset(keep)
+  else:
+    price_guide = [e for (e, k) in zip(price_guide, keep.tolist()) if k]
+  return (price_guide, stores, report)
+
+################################################################################
+
+def brute_force(wanted_parts, price_guide, k, n_best=None):
+  """Find all combinations of k stores that can cover the wanted parts
+
+  Combinations are enumerated in the same order as itertools.combinations,
+  but with branch-and-bound: a partial combination is abandoned as soon as the
+  stores left to choose from can't cover some wanted part, or (if only the
+  n_best cheapest combinations are wanted) as soon as it can't beat the
+  n_best cheapest found so far.
+  """
+  guide = pricing.as_price_guide(price_guide)
+  stores = guide.store_ids
+  wanted_items = guide.wanted_items(wanted_parts).tolist()
+  wanted = [(item['Qty'], kk) for (item, kk) in zip(wanted_parts, wanted_items)]
+  wanted_index = {}
+  for (w, kk) in enumerate(wanted_items):
+    wanted_index.setdefault(kk, []).append(w)
+
+  # how much of each wanted item each store has, and all lots for each wanted
+  # item sorted by price
+  supply = [{} for s in stores]
+  suppliers = [[] for w in wanted]
+  lots = [[] for w in wanted]
+  pairs = zip(guide.pair_store.tolist(), guide.pair_item.tolist(), guide.pair_quantity.tolist())
+  for (i, kk, quantity) in pairs:
+    for w in wanted_index.get(kk, []):
+      supply[i][w] = quantity
+      suppliers[w].append((quantity, i))
+  for (w, (qty, kk)) in enumerate(wanted):
+    suppliers[w] = list(sorted(suppliers[w], key=lambda x: -x[0]))
+    if kk >= 0:
+      item_lots = guide.item_lots[guide.item_offsets[kk]:guide.item_offsets[kk + 1]]
+      lots[w] = zip(guide.unit_cost[item_lots].tolist(),
+                    guide.store[item_lots].tolist(),
+                    guide.quantity[item_lots].tolist())
+
+  def can_cover(chosen, have, start):
+    # can the chosen stores plus the best len(stores) - start others cover
+    # every wanted item?
+    n_remaining = k - len(chosen)
+    for (w, (qty, kk)) in enumerate(wanted):
+      needed = qty - have[w]
+      if needed <= 0:
+        continue
+      n_used = 0
+      for (quantity, i) in suppliers[w]:
+        if n_used == n_remaining or needed <= 0:
+          break
+        if i >= start:
+          needed -= quantity
+          n_used += 1
+      if needed > 0:
+        return False
+    return True
+
+  def lower_bound(chosen, start):
+    # cheapest way to buy everything from the chosen stores and all stores
+    # that could still be added
+    allowed = set(chosen)
+    cost = 0.0
+    for (w, (qty, kk)) in enumerate(wanted):
+      n_remaining = qty
+      for (unit_cost, i, quantity) in lots[w]:
+        if n_remaining <= 0:
+          break
+        if i >= start or i in allowed:
+          amount = min(n_remaining, quantity)
+          cost += amount * unit_cost
+          n_remaining -= amount
+    return cost
+
+  best = []     # heap of (-cost, -order) of the n_best cheapest so far
+  results = {}  # order found in to solution
+
+  def search(chosen, have, start):
+    if len(stores) - start < k - len(chosen):
+      return
+    if not can_cover(chosen, have, start):
+      return
+
+    if len(chosen) == k:
       # calculate minimum cost to buy everything using these stores
-      cost, allocation = min_cost(wanted_parts, inventory)
-      results.append({
+      allowed = np.zeros(len(stores), dtype=bool)
+      allowed[chosen] = True
+      cost, allocation = guide_min_cost(wanted_parts, guide, allowed)
+      order = n_found[0]
+      n_found[0] += 1
+      results[order] = {
         'cost': cost,
         'allocation': allocation,
-        'store_ids': selected_stores
-      })
-      #print 'Solution: k=%d, cost=%8.2f, store_ids=%40s' % (k, cost, selected_stores)
-    else:
-      #print 'Unable to fill quote using store_ids=%40s' % (selected_stores,)
-      pass
-  return results
+        'store_ids': tuple(stores[i] for i in chosen)
+      }
+      if n_best is not None:
+        heapq.heappush(best, (-cost, -order))
+        if len(best) > n_best:
+          (_, worst_order) = heapq.heappop(best)
+          del results[-worst_order]
+      return
+
+    if n_best is not None and len(best) == n_best:
+      worst = -best[0][0]
+      if lower_bound(chosen, start) > worst + 1e-6 * max(1.0, worst):
+        return
+
+    for i in range(start, len(stores)):
+      chosen.append(i)
+      for (w, quantity) in supply[i].iteritems():
+        have[w] += quantity
+      search(chosen, have, i + 1)
+      for (w, quantity) in supply[i].iteritems():
+        have[w] -= quantity
+      chosen.pop()
+
+  n_found = [0]
+  search([], [0] * len(wanted), 0)
+
+  return [results[order] for order in sorted(results.keys())]
 
 
 def min_cost(wanted_parts, available_parts):
   """Greedily minimize the cost of all wanted parts"""
-  kf = lambda x: (x['item_id'], x['wanted_color_id'])
-  available_parts = utils.groupby(available_parts, kf)
+  return guide_min_cost(wanted_parts, pricing.as_price_guide(available_parts))
 
+
+def guide_min_cost(wanted_parts, guide, allowed=None):
+  """min_cost, only buying from stores where allowed[store index] is True"""
   result = []
   cost = 0.0
-  for item in wanted_parts:
-    item_id = item['ItemID']
-    color_id = item['ColorID']
-    matching = available_parts.get((item_id, color_id), [])
-    matching = list(sorted(matching, key=lambda x: -1 * x['cost_per_unit']))
+  for (item, k) in zip(wanted_parts, guide.wanted_items(wanted_parts).tolist()):
+    if k >= 0:
+      matching = guide.item_lots[guide.item_offsets[k]:guide.item_offsets[k + 1]]
+      if allowed is not None:
+        matching = matching[allowed[guide.store[matching]]]
+      matching = matching.tolist()
+    else:
+      matching = []
 
     # take as much inventory as possible, starting with the lowest price, until
     # the requested quantity is filled
     n_remaining = item['Qty']
-    while n_remaining > 0:
-      if len(matching) == 0:
-        print 'WARNING: couldn\'t find enough inventory to purchase %s' % (item['ItemName'],)
-        cost = float('inf')
+    for i in matching:
+      if n_remaining <= 0:
         break
 
-      next = matching.pop()
-      amount = min(n_remaining, next['quantity_available'])
+      amount = min(n_remaining, int(guide.quantity[i]))
       r = {
-        'item_id': next['item_id'],
-        'color_id': next['color_id'],
-        'store_id': next['store_id'],
+        'item_id': item['ItemID'],
+        'color_id': int(guide.color_id[i]),
+        'store_id': guide.store_ids[guide.store[i]],
         'quantity': amount,
-        'cost_per_unit': next['cost_per_unit']
+        'cost_per_unit': float(guide.unit_cost[i])
       }
       result.append(r)
       n_remaining -= amount
-      cost += amount * next['cost_per_unit']
+      cost += amount * r['cost_per_unit']
+
+    if n_remaining > 0:
+      print 'WARNING: couldn\'t find enough inventory to purchase %s' % (item['ItemName'],)
+      cost = float('inf')
 
   return (cost, result)
 
 
 def covers(wanted_parts, available_parts):
   """True if the given stores can cover all desired items"""
-  kf = lambda x: (x['item_id'], x['wanted_color_id'])
-  available_parts = utils.groupby(available_parts, kf)
-
-  for item in wanted_parts:
-    item_id = item['ItemID']
-    color_id = item['ColorID']
-    quantity = item['Qty']
-    available = available_parts.get((item_id, color_id), [])
-    inventory = sum(e['quantity_available'] for e in available)
+  guide = pricing.as_price_guide(available_parts)
+  inventory = np.bincount(guide.item, weights=guide.quantity, minlength=len(guide.items))
 
-    if inventory < quantity:
+  for (item, k) in zip(wanted_parts, guide.wanted_items(wanted_parts).tolist()):
+    if k < 0 or inventory[k] < item['Qty']:
       return False
   return True
 
@@ -88,94 +326,116 @@ def covers(wanted_parts, available_parts):
 
 def greedy(wanted_parts, price_guide):
   """Greedy Set-Cover algorithm to minimize number of stores purchased from.
-  Disregards prices in decisions."""
-  result = []
-
-  available_parts = utils.groupby(price_guide, lambda x: x['store_id'])
-  available_parts = copy.deepcopy(available_parts)
-
-  wanted_parts = copy.deepcopy(wanted_parts)
-  wanted_by_item = utils.groupby(wanted_parts, lambda x: (x['ItemID'], x['ColorID']))
-
-  # while we don't have all the parts we need
-  while len(wanted_parts) > 0 and len(available_parts) > 0:
-    # calculate how many parts each vendor can cover
-    def coverage(inventory):
-      kf = lambda x: (x['item_id'], x['wanted_color_id'])
-      # only worry about items wanted
-      wanted = filter(lambda x: kf(x) in wanted_by_item, inventory)
+  Disregards prices in decisions.
 
-      # count up how much there is of each (item_id, color_id) pair
-      wanted = utils.groupby(wanted, kf)
-      wanted = map(lambda x: (x[0], sum(e['quantity_available'] for e in x[1])),
-                   wanted.iteritems())
+  Stores are kept in a max-heap keyed on how many wanted parts they can
+  provide. A store's coverage can only shrink as parts are bought, so it is
+  only recomputed when the store reaches the top of the heap after one of the
+  lots it sells was (partially) filled.
+  """
+  guide = pricing.as_price_guide(price_guide)
+  store_ids = guide.store_ids
+  pair_item = guide.pair_item.tolist()
+  pair_quantity = guide.pair_quantity.tolist()
+  store_pairs = guide.store_pair_offsets.tolist()
 
-      # count how much of each item I'd buy
-      tot = 0
-      for (k, v) in wanted:
-        if k in wanted_by_item:
-          tot += min(wanted_by_item[k][0]['Qty'], v)
+  result = []
 
-      return tot
+  # which stores sell each part
+  sellers = {}
+  for (s, k) in zip(guide.pair_store.tolist(), pair_item):
+    sellers.setdefault(k, []).append(s)
+
+  # quantity still needed of each wanted lot
+  wanted_qty = [item['Qty'] for item in wanted_parts]
+  wanted_by_item = {}
+  for (w, k) in enumerate(guide.wanted_items(wanted_parts).tolist()):
+    if k >= 0:
+      wanted_by_item.setdefault(k, []).append(w)
+  n_wanted = len(wanted_parts)
+
+  def coverage(s):
+    # count how much of each wanted item I'd buy
+    tot = 0
+    for p in range(store_pairs[s], store_pairs[s + 1]):
+      if pair_item[p] in wanted_by_item:
+        tot += min(wanted_qty[wanted_by_item[pair_item[p]][0]], pair_quantity[p])
+    return tot
+
+  # ties go to the store that comes last in the price guide's store order
+  heap = [(-coverage(s), -s, s) for s in range(len(store_ids))]
+  heapq.heapify(heap)
+  stale = set()
 
-    coverages = [(k, v, coverage(v)) for (k, v) in available_parts.iteritems()]
-    coverages = list(sorted(coverages, key=lambda x: x[2]))
+  # while we don't have all the parts we need
+  while n_wanted > 0 and len(heap) > 0:
+    neg_coverage, neg_rank, next_store = heapq.heappop(heap)
+    if next_store in stale:
+      stale.remove(next_store)
+      heapq.heappush(heap, (-coverage(next_store), neg_rank, next_store))
+      continue
 
     # use the store that has the most inventory
-    next_store, inventory, n_parts = coverages.pop()
-    #print 'You can buy %d items from %s' % (n_parts, next_store)
+    n_parts = -neg_coverage
+    #print 'You can buy %d items from %s' % (n_parts, store_ids[next_store])
     if n_parts == 0:
       break
 
-    # update the quantities in the wanted parts list
-    by_item = utils.groupby(inventory,
-                            lambda x: (x['item_id'], x['wanted_color_id']))
-    new_wanted_parts = []
-    for item in wanted_parts:
-      # get all lots from next_store matching item
-      item_id = item['ItemID']
-      color_id = item['ColorID']
-      wanted_qty = item['Qty']
-
-      available = by_item.get((item_id, color_id), [])
-      available = list(sorted(available, key=lambda x: -1 * x['cost_per_unit']))
+    # update the quantities in the wanted parts list, in the order of the
+    # wanted parts list
+    by_item = dict(
+        (pair_item[p], p)
+        for p in range(store_pairs[next_store], store_pairs[next_store + 1])
+    )
+    filled = sorted(utils.flatten(
+        wanted_by_item.get(k, []) for k in by_item
+    ))
+    for w in filled:
+      # get all lots from next_store matching item, cheapest first
+      item = wanted_parts[w]
+      k = guide.wanted_items([item])[0]
+      p = by_item[k]
+      available = guide.store_lots[guide.pair_offsets[p]:guide.pair_offsets[p + 1]].tolist()
 
       # keep buying up lots until the wanted_qty is full or the store is bought
       # out
-      while wanted_qty > 0 and len(available) > 0:
-        next = available.pop()
+      for i in available:
+        if wanted_qty[w] <= 0:
+          break
 
-        amount_to_buy = min(next['quantity_available'], wanted_qty)
+        amount_to_buy = min(int(guide.quantity[i]), wanted_qty[w])
 
         result.append({
-          'store_id': next['store_id'],
-          'item_id': item_id,
-          'wanted_color_id': next['wanted_color_id'],
-          'color_id': next['color_id'],
-          'quantity_available': next['quantity_available'],
-          'cost_per_unit': next['cost_per_unit'],
+          'store_id': store_ids[next_store],
+          'item_id': item['ItemID'],
+          'wanted_color_id': guide.items[k][1],
+          'color_id': int(guide.color_id[i]),
+          'quantity_available': int(guide.quantity[i]),
+          'cost_per_unit': float(guide.unit_cost[i]),
           'quantity': amount_to_buy,
         })
 
-        wanted_qty -= amount_to_buy
+        wanted_qty[w] -= amount_to_buy
 
-      # this store couldn't fill out our order
-      if wanted_qty > 0:
-        item['Qty'] = wanted_qty
-        new_wanted_parts.append(item)
+    # remove what's been filled from the wanted parts list. Every store selling
+    # something that was bought needs its coverage recomputed.
+    for w in filled:
+      k = guide.wanted_items([wanted_parts[w]])[0]
+      if wanted_qty[w] == 0:
+        wanted_by_item[k].remove(w)
+        n_wanted -= 1
+        if len(wanted_by_item[k]) == 0:
+          del wanted_by_item[k]
+      stale.update(sellers[k])
+    stale.discard(next_store)
 
-    # update wanted parts list, remove store from inventory
-    wanted_parts = new_wanted_parts
-    wanted_by_item = utils.groupby(wanted_parts,
-                                   lambda x: (x['ItemID'], x['ColorID']))
-    del available_parts[next_store]
+    #print 'Wanted parts left: %d' % sum(wanted_qty)
 
-    #print 'Wanted parts left: %d' % sum(e['Qty'] for e in wanted_parts)
 
-
-  if len(wanted_parts) > 0:
+  remaining = [item for (w, item) in enumerate(wanted_parts) if wanted_qty[w] > 0]
+  if len(remaining) > 0:
     print 'WARNING: there wasn\'t enough availability to buy the following items:'
-    print ", ".join(e['ItemName'] for e in wanted_parts)
+    print ", ".join(e['ItemName'] for e in remaining)
 
   cost = sum(e['quantity'] * e['cost_per_unit'] for e in result)
   store_ids = list(set(e['store_id'] for e in result))
@@ -185,125 +445,789 @@ def greedy(wanted_parts, price_guide):
     'store_ids': store_ids
   }]
 
+
+def local_search(wanted_parts, price_guide, stores=None, shipping_cost=10.0,
+                 initial=None, max_iterations=1000, time_limit=None, max_candidates=20):
+  """Improve a solution by changing which stores are used, one at a time
+
+  Starting from `initial` (by default, the greedy solution), repeatedly try
+  to drop a store, swap a store for another, or add a store, and keep the
+  first change that lowers the cost of parts plus shipping. Parts are always
+  bought as cheaply as possible from the chosen stores, as in min_cost. Stores
+  where less than the minimum buy would be spent are dropped.
+
+  Parameters
+  ----------
+  stores : list of store metadata or None
+      minimum buy of each store. If None, no store has a minimum buy.
+  max_iterations : int
+      maximum number of changes to make
+  time_limit : float or None
+      stop looking for changes after this many seconds
+  max_candidates : int
+      number of other stores to try when swapping or adding a store
+
+  The solution's 'local_search' entry has the number of iterations and the
+  cost (including shipping) before and after.
+  """
+  start = time.time()
+  guide = pricing.as_price_guide(price_guide)
+  n_stores = len(guide.store_ids)
+  if initial is None:
+    initial = greedy(wanted_parts, guide)[0]
+
+  minimum_buy = np.zeros(n_stores)
+  if stores is not None:
+    for s in stores:
+      i = guide.store_index(s['store_id'])
+      if i >= 0:
+        minimum_buy[i] = s['minimum_buy']
+
+  wanted = wanted_quantities(guide, wanted_parts)
+  if wanted is None:
+    print 'No solution :('
+    return []
+
+  def evaluate(chosen):
+    # cheapest way to buy everything from the chosen stores, plus shipping
+    chosen = chosen.copy()
+    while True:
+      quantities = store_set_quantities(guide, wanted, chosen)
+      if quantities is None:
+        return (INFINITY, None)
+      spent = np.bincount(guide.store, weights=quantities * guide.unit_cost, minlength=n_stores)
+      used = np.bincount(guide.store, weights=quantities, minlength=n_stores) > 0
+      short = used & (spent < minimum_buy)
+      if not short.any():
+        return (spent.sum() + shipping_cost * used.sum(), quantities)
+      chosen &= ~short
+
+  # stores that sell each part
+  sellers = {}
+  for (s, k) in zip(guide.pair_store.tolist(), guide.pair_item.tolist()):
+    sellers.setdefault(k, []).append(s)
+
+  def neighbors(chosen, quantities):
+    # chosen stores, least spent at first
+    spent = np.bincount(guide.store, weights=quantities * guide.unit_cost, minlength=n_stores)
+    in_use = [s for s in np.argsort(spent, kind='mergesort').tolist() if chosen[s]]
+
+    # drop a store
+    for s in in_use:
+      candidate = chosen.copy()
+      candidate[s] = False
+      yield candidate
+
+    # swap a store for one that sells the most of what's bought there
+    for s in in_use:
+      lots = guide.store == s
+      bought = np.bincount(guide.item[lots], weights=quantities[lots], minlength=len(guide.items))
+      supply = {}
+      for k in np.flatnonzero(bought).tolist():
+        for t in sellers[k]:
+          if not chosen[t]:
+            supply[t] = supply.get(t, 0) + 1
+      for t in sorted(supply, key=lambda t: (-supply[t], t))[:max_candidates]:
+        candidate = chosen.copy()
+        candidate[s] = False
+        candidate[t] = True
+        yield candidate
+
+    # add a store that sells something cheaper than what's paid now
+    paid = np.zeros(len(guide.items))
+    bought_lots = np.flatnonzero(quantities > 0)
+    np.maximum.at(paid, guide.item[bought_lots], guide.unit_cost[bought_lots])
+    savings = np.maximum(paid[guide.item] - guide.unit_cost, 0.0) * \
+              np.minimum(guide.quantity, np.bincount(guide.item, weights=quantities,
+                                                     minlength=len(guide.items))[guide.item])
+    savings = np.bincount(guide.store, weights=savings, minlength=n_stores)
+    savings[chosen] = 0.0
+    for t in np.argsort(-savings, kind='mergesort')[:max_candidates].tolist():
+      if savings[t] <= 0:
+        break
+      candidate = chosen.copy()
+      candidate[t] = True
+      yield candidate
+
+  chosen = np.zeros(n_stores, dtype=bool)
+  for store_id in initial['store_ids']:
+    if guide.store_index(store_id) >= 0:
+      chosen[guide.store_index(store_id)] = True
+  (cost, quantities) = evaluate(chosen)
+  if quantities is None:
+    # the initial stores can't cover everything or don't reach their minimum
+    # buys. Start from every store instead.
+    chosen[:] = True
+    (cost, quantities) = evaluate(chosen)
+    if quantities is None:
+      print 'No solution :('
+      return []
+  initial_cost = cost
+
+  iterations = 0
+  improved = True
+  while improved and iterations < max_iterations:
+    improved = False
+    for candidate in neighbors(chosen, quantities):
+      if time_limit is not None and time.time() - start > time_limit:
+        break
+      (candidate_cost, candidate_quantities) = evaluate(candidate)
+      if candidate_cost < cost - 1e-9:
+        # only keep stores something is bought from
+        chosen = np.bincount(guide.store, weights=candidate_quantities, minlength=n_stores) > 0
+        (cost, quantities) = (candidate_cost, candidate_quantities)
+        iterations += 1
+        improved = True
+        break
+
+  solution = guide_solution(guide, quantities)
+  solution['local_search'] = {
+    'iterations': iterations,
+    'initial_cost': initial_cost,
+    'final_cost': cost,
+    'seconds': time.time() - start,
+  }
+  return [solution]
+
+
+def wanted_quantities(guide, wanted_parts):
+  """Quantity wanted of each part of a price guide, or None if some wanted
+  part isn't sold at all"""
+  wanted_items = guide.wanted_items(wanted_parts)
+  if (wanted_items < 0).any():
+    return None
+  wanted = np.zeros(len(guide.items))
+  np.add.at(wanted, wanted_items, [item['Qty'] for item in wanted_parts])
+  return wanted
+
+
+def store_set_quantities(guide, wanted_qty, allowed):
+  """How much to buy of each lot to buy everything as cheaply as possible from
+  some stores, or None if they don't have enough
+
+  Parameters
+  ----------
+  wanted_qty : array with the quantity wanted of each part of the guide
+  allowed : boolean array with an entry per store
+  """
+  # lots of allowed stores, grouped by part and cheapest first
+  lots = guide.item_lots[allowed[guide.store[guide.item_lots]]]
+  items = guide.item[lots]
+  available = guide.quantity[lots]
+
+  # how much is available from cheaper lots of the same part
+  cumulative = np.cumsum(available) - available
+  first = np.searchsorted(items, items)
+  before = cumulative - cumulative[first]
+
+  amounts = np.clip(wanted_qty[items] - before, 0, available)
+  if (np.bincount(items, weights=amounts, minlength=len(wanted_qty)) < wanted_qty).any():
+    return None
+  quantities = np.zeros(len(guide))
+  quantities[lots] = amounts
+  return quantities
+
+
 ################################################################################
 
+def ilp(wanted_parts, available_parts, stores, shipping_cost=10.0, solver='gurobi',
+        gap=0.01, time_limit=None, callback=None):
+  """Minimize the cost of all wanted parts plus shipping with an Integer
+  Linear Program.
+
+  Parameters
+  ----------
+  solver : str
+      which solver to use. One of 'gurobi' (requires gurobipy) or 'cbc'
+      (requires PuLP)
+  gap : float
+      stop once the solution is provably within this fraction of the optimum
+  time_limit : float or None
+      stop after this many seconds and return the best solution found so far
+  callback : function or None
+      called as callback(solution, info) with every new best solution found.
+      info has the objective (cost including shipping), the best bound on the
+      objective (None if unknown) and the seconds elapsed. Only Gurobi reports
+      solutions as it finds them; the other solvers only report the final one.
+
+  The solution's 'timing' entry says how many seconds were spent building the
+  model, solving it and extracting the solution.
+  """
+  start = time.time()
+  model = ilp_model(wanted_parts, available_parts, stores, shipping_cost)
+  built = time.time()
+  if model is None:
+    print 'No solution :('
+    return []
+
+  values = SOLVERS[solver](model, gap=gap, time_limit=time_limit,
+                           callback=ilp_callback(model, callback))
+  solved = time.time()
+  if values is None:
+    print 'No solution :('
+    return []
+
+  solution = ilp_solution(model, values)
+  solution['timing'] = {
+    'build': built - start,
+    'solve': solved - built,
+    'extract': time.time() - solved,
+  }
+  return [solution]
+
+
+def ilp_callback(model, callback):
+  """Turn a callback taking solutions into one taking values of variables"""
+  if callback is None:
+    return None
+  return lambda values, info: callback(ilp_solution(model, values), info)
+
+
+def ilp_alternatives(wanted_parts, available_parts, stores, n_solutions, shipping_cost=10.0,
+                     solver='gurobi', gap=0.01, time_limit=None):
+  """Find the cheapest ways to buy everything, each from a different set of
+  stores
+
+  The ILP is solved up to n_solutions times. After each solve, a constraint
+  is added that rules out the set of stores just found (a "no-good cut").
+  Solutions are returned cheapest first, including shipping. With a nonzero
+  gap or a time limit they aren't necessarily the n_solutions cheapest sets
+  of stores. Other parameters are the same as for ilp(); time_limit applies
+  to each solve.
+  """
+  model = ilp_model(wanted_parts, available_parts, stores, shipping_cost)
+  if model is None:
+    print 'No solution :('
+    return []
+
+  # a store only counts as used if at least one part is bought there.
+  # Otherwise the same purchase would come back with unused stores paid for.
+  guide = model['guide']
+  n_stores = len(model['store_ids'])
+  counts = np.diff(guide.store_offsets) + 1
+  indptr = np.concatenate([[0], np.cumsum(counts)])
+  indices = np.zeros(len(guide) + n_stores, dtype=int)
+  data = np.ones(len(guide) + n_stores)
+  lot_position = np.arange(len(guide)) + guide.store[guide.store_lots]
+  indices[lot_position] = n_stores + guide.store_lots
+  indices[indptr[1:] - 1] = np.arange(n_stores)
+  data[indptr[1:] - 1] = -1.0
+  model = ilp_add_rows(model, indptr, indices, data,
+                       np.zeros(n_stores), np.repeat(INFINITY, n_stores))
+
+  solutions = []
+  for i in range(n_solutions):
+    values = SOLVERS[solver](model, gap=gap, time_limit=time_limit)
+    if values is None:
+      break
+    solutions.append(ilp_solution(model, values))
+
+    # at least one of the stores used must be dropped or another one added
+    used = np.round(np.asarray(values, dtype=float)[:n_stores]) > 0
+    model = ilp_add_row(model, np.arange(n_stores), np.where(used, -1.0, 1.0),
+                        1.0 - used.sum(), INFINITY)
+
+  # solves stopped by the gap or time limit can come out of order
+  solutions.sort(key=lambda s: s['cost'] + shipping_cost * len(s['store_ids']))
+  return solutions
+
+
 def gurobi(wanted_parts, available_parts, stores, shipping_cost=10.0):
-  from gurobipy import Model, GRB, LinExpr
+  """Minimize the cost of a purchase with Gurobi"""
+  return ilp(wanted_parts, available_parts, stores, shipping_cost, solver='gurobi')
+
+
+def reoptimize(wanted_parts, previous, price_guide, stores, delta=None,
+               shipping_cost=10.0, solver='gurobi', gap=0.01, time_limit=None, callback=None):
+  """Minimize the cost of a purchase again after the price guide changed
+
+  The previous solution is repaired to fit the new price guide and used to
+  warm start the ILP. If nothing was added to the price guide and the previous
+  solution can still be bought as is, it's still the best and no ILP is
+  solved.
+
+  Parameters
+  ----------
+  previous : dict
+      solution for the old price guide, as returned by ilp()
+  price_guide : list of lots or pricing.PriceGuide
+      the new price guide
+  delta : dict or None
+      changes from the old to the new price guide, as returned by
+      pricing.diff(). If None, the ILP is always solved.
+
+  The other parameters are the same as for ilp().
+
+  The solution's 'warm_start' entry says what happened: 'unchanged' if the
+  previous solution was kept, 'repaired' if the ILP was started from the
+  repaired solution, or 'cold' if it couldn't be repaired.
+  """
+  start = time.time()
+  guide = pricing.as_price_guide(price_guide)
+  quantities, changed = repair(wanted_parts, previous['allocation'], guide, stores)
+  repaired = time.time()
+
+  if quantities is not None and not changed and delta is not None and len(delta['added']) == 0:
+    solution = guide_solution(guide, quantities)
+    solution['warm_start'] = 'unchanged'
+    solution['timing'] = {'build': repaired - start, 'solve': 0.0, 'extract': 0.0}
+    return [solution]
+
+  model = ilp_model(wanted_parts, guide, stores, shipping_cost)
+  if model is None:
+    print 'No solution :('
+    return []
+  values = ilp_start(model, quantities) if quantities is not None else None
+  built = time.time()
 
-  kf1 = lambda x: (x['item_id'], x['wanted_color_id'])
-  kf2 = lambda x: (x['ItemID'], x['ColorID'])
+  values = SOLVERS[solver](model, gap=gap, start=values, time_limit=time_limit,
+                           callback=ilp_callback(model, callback))
+  solved = time.time()
+  if values is None:
+    print 'No solution :('
+    return []
+
+  solution = ilp_solution(model, values)
+  solution['warm_start'] = 'repaired' if quantities is not None else 'cold'
+  solution['timing'] = {
+    'build': built - start,
+    'solve': solved - built,
+    'extract': time.time() - solved,
+  }
+  return [solution]
+
+
+def repair(wanted_parts, allocation, price_guide, stores=None):
+  """Adapt an allocation to a different price guide
+
+  Lots of the allocation are bought again wherever the price guide still has
+  them. What can't be bought anymore is replaced by the cheapest lots,
+  preferring stores that are already used.
+
+  Returns
+  -------
+  (quantities, changed) where quantities is how much to buy of each lot of the
+  price guide, or None if no valid allocation was found, and changed is True
+  if the allocation had to change.
+  """
+  guide = pricing.as_price_guide(price_guide)
+  remaining = guide.quantity.copy()
+  quantities = np.zeros(len(guide), dtype=np.int64)
+
+  # where each lot is in the price guide
+  lots_by_key = {}
+  store_ids = guide.store_ids
+  items = guide.items
+  columns = zip(guide.store.tolist(), guide.item.tolist(),
+                guide.color_id.tolist(), guide.unit_cost.tolist())
+  for (i, (s, k, color_id, unit_cost)) in enumerate(columns):
+    key = (store_ids[s], items[k][0], items[k][1], color_id, unit_cost)
+    lots_by_key.setdefault(key, []).append(i)
+
+  # buy what can still be bought
+  changed = False
+  for lot in allocation:
+    needed = lot['quantity']
+    for i in lots_by_key.get(pricing.lot_key(lot), []):
+      amount = min(needed, remaining[i])
+      quantities[i] += amount
+      remaining[i] -= amount
+      needed -= amount
+    changed = changed or needed > 0
+
+  # buy whatever's missing, cheapest first from stores already in use, then
+  # from anywhere
+  used = np.zeros(len(store_ids), dtype=bool)
+  used[guide.store[quantities > 0]] = True
+  bought = np.bincount(guide.item, weights=quantities, minlength=len(items))
+  for (item, k) in zip(wanted_parts, guide.wanted_items(wanted_parts).tolist()):
+    if k < 0:
+      return (None, True)
+    needed = item['Qty'] - int(bought[k])
+    matching = guide.item_lots[guide.item_offsets[k]:guide.item_offsets[k + 1]]
+    matching = np.concatenate([matching[used[guide.store[matching]]],
+                               matching[~used[guide.store[matching]]]])
+    for i in matching.tolist():
+      if needed <= 0:
+        break
+      amount = min(needed, remaining[i])
+      quantities[i] += amount
+      remaining[i] -= amount
+      needed -= amount
+      changed = True
+    if needed > 0:
+      return (None, True)
+
+  if not is_valid_solution(wanted_parts, guide_solution(guide, quantities)['allocation'], stores):
+    return (None, True)
+  return (quantities, changed)
+
+
+def ilp_model(wanted_parts, available_parts, stores, shipping_cost=10.0):
+  """Build a solver-independent Integer Linear Program for minimizing cost
 
-  available_by_store = utils.groupby(available_parts, lambda x: x['store_id'])
+  Variable j < n_stores is 1 if anything is bought from store store_ids[j];
+  variable n_stores + i is how much to buy of lot i of the price guide.
+  Constraints are the rows of a sparse matrix A in CSR format (A_indptr,
+  A_indices, A_data), with row_lower <= A x <= row_upper.
+
+  Returns None if some wanted part isn't sold by any store.
+  """
+  guide = pricing.as_price_guide(available_parts)
   store_by_id = dict( (s['store_id'], s) for s in stores )
 
+  store_ids = guide.store_ids
+  n_stores = len(store_ids)
+  n_lots = len(guide)
+
+  lot_store = guide.store
+  quantity = guide.quantity.astype(float)
+  unit_cost = guide.unit_cost
+  lot_variable = n_stores + np.arange(n_lots)
+
+  # one entry per wanted lot / store
+  wanted_item = guide.wanted_items(wanted_parts)
+  wanted_qty = np.array([e['Qty'] for e in wanted_parts], dtype=float)
+  minimum_buy = np.array([store_by_id[s]['minimum_buy'] for s in store_ids], dtype=float)
+
+  if (wanted_item < 0).any():
+    return None
+
+  # a constraint for how much can be bought of each lot:
+  #   quantity bought - quantity available * use store <= 0
+  maxquantity_indices = np.column_stack([lot_variable, lot_store]).ravel()
+  maxquantity_data = np.column_stack([np.ones(n_lots), -quantity]).ravel()
+  maxquantity_counts = np.repeat(2, n_lots)
+
+  # a constraint saying amount bought >= wanted amount, for every wanted lot
+  item_offsets = guide.item_offsets
+  wantedamount_indices = np.concatenate(
+      [lot_variable[guide.item_lots[item_offsets[k]:item_offsets[k + 1]]] for k in wanted_item] +
+      [np.zeros(0, dtype=int)]
+  )
+  wantedamount_data = np.ones(len(wantedamount_indices))
+  wantedamount_counts = np.diff(item_offsets)[wanted_item]
+
+  # a constraint saying "if I purchased from this store, I bought the minimum
+  # amount or more": each store's lots, followed by the store variable
+  by_store = guide.store_lots
+  store_counts = np.diff(guide.store_offsets) + 1
+  minbuy_indices = np.zeros(n_lots + n_stores, dtype=int)
+  minbuy_data = np.zeros(n_lots + n_stores)
+  lot_position = np.arange(n_lots) + lot_store[by_store]
+  store_position = np.cumsum(store_counts) - 1
+  minbuy_indices[lot_position] = lot_variable[by_store]
+  minbuy_data[lot_position] = unit_cost[by_store]
+  minbuy_indices[store_position] = np.arange(n_stores)
+  minbuy_data[store_position] = -minimum_buy
+
+  row_counts = np.concatenate([maxquantity_counts, wantedamount_counts, store_counts])
+  return {
+    'store_ids': store_ids,
+    'guide': guide,
+    'objective': np.concatenate([np.repeat(float(shipping_cost), n_stores), unit_cost]),
+    'var_upper': np.concatenate([np.ones(n_stores), quantity]),
+    'integer': np.concatenate([np.ones(n_stores, dtype=bool), np.zeros(n_lots, dtype=bool)]),
+    'A_indptr': np.concatenate([[0], np.cumsum(row_counts)]),
+    'A_indices': np.concatenate([maxquantity_indices, wantedamount_indices, minbuy_indices]),
+    'A_data': np.concatenate([maxquantity_data, wantedamount_data, minbuy_data]),
+    'row_lower': np.concatenate([np.repeat(-INFINITY, n_lots), wanted_qty, np.zeros(n_stores)]),
+    'row_upper': np.concatenate([np.zeros(n_lots), np.repeat(INFINITY, len(wanted_parts) + n_stores)]),
+  }
+
+
+def ilp_rows(model):
+  """Iterate over (variable indices, coefficients, lower, upper) for every
+  constraint of an ILP model"""
+  indptr = model['A_indptr']
+  indices = model['A_indices'].tolist()
+  data = model['A_data'].tolist()
+  for (r, (lower, upper)) in enumerate(zip(model['row_lower'].tolist(), model['row_upper'].tolist())):
+    yield (indices[indptr[r]:indptr[r + 1]], data[indptr[r]:indptr[r + 1]], lower, upper)
+
+
+def ilp_solution(model, values):
+  """Turn values for every variable of an ILP model into a solution"""
+  guide = model['guide']
+  n_stores = len(model['store_ids'])
+  values = np.asarray(values, dtype=float)[n_stores:]
+  quantities = np.round(values)
+
+  # lot variables are continuous, so they might not actually be integral.
+  # If they're not, check that they're "almost" integral, so we can just
+  # round. Otherwise, print this warning.  According to theory the optimal
+  # solution is for all continuous variables to be integral.
+  for i in np.nonzero(np.abs(values - quantities) > 1e-3)[0]:
+    lot = guide.lot(i)
+    print 'Uh oh. Lot store=%s-item=%s-color=%s has value %f. This is a little close for comfort.' % (
+        lot['store_id'], lot['item_id'], lot['color_id'], values[i])
+
+  return guide_solution(guide, quantities)
+
+
+def ilp_start(model, quantities):
+  """Values for every variable of an ILP model, given how much to buy of
+  each lot"""
+  guide = model['guide']
+  used = np.zeros(len(model['store_ids']))
+  used[guide.store[quantities > 0]] = 1.0
+  return np.concatenate([used, quantities])
+
+
+def ilp_cutoff(model, values):
+  """An ILP model that only allows solutions at least as good as `values`"""
+  n_variables = len(model['objective'])
+  cutoff = np.dot(model['objective'], values)
+  cutoff += 1e-6 * max(1.0, abs(cutoff))
+  return ilp_add_row(model, np.arange(n_variables), model['objective'], -INFINITY, cutoff)
+
+
+def ilp_feasible(model, values, tolerance=1e-6):
+  """Whether values satisfy every bound, integrality and row of a model"""
+  x = np.asarray(values, dtype=float)
+  if (x < -tolerance).any() or (x > model['var_upper'] + tolerance).any():
+    return False
+  integer = model['integer'].astype(bool)
+  if (np.abs(x[integer] - np.round(x[integer])) > tolerance).any():
+    return False
+  n_rows = len(model['row_lower'])
+  rows = np.repeat(np.arange(n_rows), np.diff(model['A_indptr']))
+  totals = np.bincount(rows, weights=model['A_data'] * x[model['A_indices']], minlength=n_rows)
+  return bool((totals >= model['row_lower'] - tolerance).all() and
+              (totals <= model['row_upper'] + tolerance).all())
+
+
+def ilp_add_row(model, indices, data, lower, upper):
+  """An ILP model with one more constraint, lower <= data . x[indices] <= upper"""
+  return ilp_add_rows(model, [0, len(indices)], indices, data, [lower], [upper])
+
+
+def ilp_add_rows(model, indptr, indices, data, lower, upper):
+  """An ILP model with more constraints, given as a matrix in CSR format"""
+  result = dict(model)
+  result['A_indptr'] = np.concatenate([model['A_indptr'], model['A_indptr'][-1] + np.asarray(indptr[1:])])
+  result['A_indices'] = np.concatenate([model['A_indices'], indices])
+  result['A_data'] = np.concatenate([model['A_data'], data])
+  result['row_lower'] = np.concatenate([model['row_lower'], lower])
+  result['row_upper'] = np.concatenate([model['row_upper'], upper])
+  return result
+
+
+def guide_solution(guide, quantities):
+  """Turn how much to buy of each lot of a price guide into a solution"""
+  result = []
+  for i in np.nonzero(quantities > 0)[0]:
+    lot = guide.lot(i)
+    lot['quantity'] = int(quantities[i])
+    result.append(lot)
+
+  cost = sum(e['quantity'] * e['cost_per_unit'] for e in result)
+  store_ids = list(set(e['store_id'] for e in result))
+  return {
+    'cost': cost,
+    'allocation': result,
+    'store_ids': store_ids
+  }
+
+
+def solve_gurobi(model, gap=0.01, start=None, time_limit=None, callback=None):
+  """Solve an ILP model with Gurobi. Returns None if there's no solution.
+
+  If given, `start` is a feasible value for every variable to start from.
+  `callback(values, info)` is called with every new incumbent.
+  """
+  from gurobipy import Model, GRB, LinExpr
+
   m = Model()
+  vtypes = [GRB.BINARY if is_integer else GRB.CONTINUOUS for is_integer in model['integer']]
+
+  if hasattr(m, 'addMVar'):
+    # gurobi >= 9 takes the whole constraint matrix at once
+    from scipy.sparse import csr_matrix
+
+    x = m.addMVar(len(vtypes), lb=0.0, ub=model['var_upper'], obj=model['objective'], vtype=vtypes)
+    A = csr_matrix((model['A_data'], model['A_indices'], model['A_indptr']),
+                   shape=(len(model['row_lower']), len(vtypes)))
+    lower = model['row_lower'] > -INFINITY
+    upper = model['row_upper'] < INFINITY
+    m.addMConstr(A[lower], x, GRB.GREATER_EQUAL, model['row_lower'][lower])
+    m.addMConstr(A[upper], x, GRB.LESS_EQUAL, model['row_upper'][upper])
+    variables = x.tolist()
+  else:
+    variables = [
+      m.addVar(0.0, u, c, vtype)
+      for (c, u, vtype) in zip(model['objective'].tolist(), model['var_upper'].tolist(), vtypes)
+    ]
 
-  store_variables     = {}  # store id to variable indicating store is used
-  quantity_variables  = []  # list of all lot variables + metadata
-
-  # for every store
-  for (store_id, inventory) in available_by_store.iteritems():
-
-    # a variable for if anything was bought from this store. if 1, then pay
-    # shipping cost and all store inventory is available; if 0, then don't pay
-    # for shipping and every lot in it has 0 quantity available
-    store_variables[store_id] = m.addVar(0.0, 1.0, shipping_cost, GRB.BINARY,
-                                         "use-store=%s" % (store_id,))
-
-    for lot in inventory:
-      store_id = lot['store_id']
-      quantity = lot['quantity_available']
-      unit_cost= lot['cost_per_unit']
-      item_id  = lot['item_id']
-      color_id = lot['color_id']
-
-      # a variable for how much to buy of this lot
-      v = m.addVar(0.0, quantity, unit_cost, GRB.CONTINUOUS,
-                   "quantity-store=%s-item=%s-color=%s" % (store_id, item_id, color_id))
-
-      # keep a list of all lots
-      quantity_variables.append({
-        'store_id': store_id,
-        'item_id': lot['item_id'],
-        'wanted_color_id': lot['wanted_color_id'],
-        'color_id': lot['color_id'],
-        'variable': v,
-        'quantity_available': quantity,
-        'cost_per_unit': unit_cost
-      })
-
-  # actually put the variables into the model
-  m.update()
-
-  # for every lot in every store
-  for lot in quantity_variables:
-    use_store = store_variables[lot['store_id']]
-    quantity  = lot['quantity_available']
-    unit_cost = lot['cost_per_unit']
-    v         = lot['variable']
-
-    # a constraint for how much can be bought
-    m.addConstr(LinExpr([1.0, -1 * quantity], [v, use_store]),
-                GRB.LESS_EQUAL, 0.0,
-                "maxquantity-store=%s-item=%s-color-%d" % (lot['store_id'], lot['item_id'], lot['color_id']))
-
-  # for every wanted lot
-  variables_by_id = utils.groupby(quantity_variables, kf1)
-  for lot in wanted_parts:
-    # a constraint saying amount bought >= wanted amount
-    variables = map(lambda x: x['variable'], variables_by_id[kf2(lot)])
-    constants = len(variables) * [1.0]
-    m.addConstr(LinExpr(constants, variables),
-                GRB.GREATER_EQUAL, lot['Qty'],
-                "wantedamount-item=%s-color=%s" % (lot['ItemID'], lot['ColorID']))
-
-  # for every store
-  variables_by_store = utils.groupby(quantity_variables, lambda x: x['store_id'])
-  for (store_id, variables) in variables_by_store.iteritems():
-    use_store         = store_variables[store_id]
-    minimum_purchase  = store_by_id[store_id]['minimum_buy']
-
-    # a constraint saying "if I purchased from this store, I bought the minimum amount or more"
-    constants = [v['cost_per_unit'] for v in variables] + [-1 * minimum_purchase]
-    variables = [v['variable'] for v in variables] + [use_store]
-    m.addConstr(LinExpr(constants, variables),
-                GRB.GREATER_EQUAL, 0.0,
-                "minbuy-store=%d" % (store_id,))
+    # actually put the variables into the model
+    m.update()
+
+    for (indices, coefficients, lower, upper) in ilp_rows(model):
+      expr = LinExpr(coefficients, [variables[j] for j in indices])
+      if lower > -INFINITY:
+        m.addConstr(expr, GRB.GREATER_EQUAL, lower)
+      if upper < INFINITY:
+        m.addConstr(expr, GRB.LESS_EQUAL, upper)
+
+  if start is not None:
+    for (v, value) in zip(variables, start):
+      v.Start = value
 
   # minimize sum of costs of items bought + shipping costs
-  m.setParam(GRB.param.MIPGap, 0.01)  # stop when duality gap <= 1%
-  m.optimize()
-
-  # get results
-  if m.ObjVal < float('inf'):
-    result = []
-    for lot in quantity_variables:
-      # get variable out
-      v = lot['variable']
-      del lot['variable']
-
-      # lot variables are continuous, so they might not actually be integral.
-      # If they're not, check that they're "almost" integral, so we can just
-      # round. Otherwise, print this warning.  According to theory the optimal
-      # solution is for all continuous variables to be integral.
-      if v.X != int(v.X) and abs(v.X - round(v.X)) > 1e-3:
-        print 'Uh oh. Variable %s has value %f. This is a little close for comfort.' % (v.VarName, v.X)
-
-      # save quantity to buy if it's > 0
-      lot['quantity'] = int(round(v.X))
-      if lot['quantity'] > 0:
-        result.append(lot)
-
-    cost = sum(e['quantity'] * e['cost_per_unit'] for e in result)
-    store_ids = list(set(e['store_id'] for e in result))
-    return [{
-      'cost': cost,
-      'allocation': result,
-      'store_ids': store_ids
-    }]
+  m.setParam(GRB.param.MIPGap, gap)  # stop when duality gap <= gap
+  if time_limit is not None:
+    m.setParam(GRB.param.TimeLimit, time_limit)
+
+  if callback is None:
+    m.optimize()
   else:
-    print 'No solution :('
-    return []
+    def on_event(m, where):
+      if where == GRB.Callback.MIPSOL:
+        callback(m.cbGetSolution(variables), {
+          'objective': m.cbGet(GRB.Callback.MIPSOL_OBJ),
+          'bound': m.cbGet(GRB.Callback.MIPSOL_OBJBND),
+          'elapsed': m.cbGet(GRB.Callback.RUNTIME),
+        })
+    m.optimize(on_event)
+
+  if m.SolCount > 0 and m.ObjVal < float('inf'):
+    return [v.X for v in variables]
+  else:
+    return None
+
+
+def solve_cbc(model, gap=0.01, start=None, time_limit=None, callback=None):
+  """Solve an ILP model with CBC via PuLP. Returns None if there's no
+  solution.
+
+  PuLP can't pass a starting solution to CBC, so `start` is only used to
+  cut off solutions that are worse.
+  """
+  import pulp
+
+  if start is not None:
+    model = ilp_cutoff(model, start)
+
+  problem = pulp.LpProblem('brickrake', pulp.LpMinimize)
+  variables = [
+    pulp.LpVariable('x%d' % j, 0.0, u, pulp.LpInteger if is_integer else pulp.LpContinuous)
+    for (j, (u, is_integer)) in enumerate(zip(model['var_upper'].tolist(), model['integer'].tolist()))
+  ]
+  problem += pulp.LpAffineExpression(zip(variables, model['objective'].tolist()))
+
+  for (indices, coefficients, lower, upper) in ilp_rows(model):
+    expr = pulp.LpAffineExpression([(variables[j], c) for (j, c) in zip(indices, coefficients)])
+    if lower > -INFINITY:
+      problem += expr >= lower
+    if upper < INFINITY:
+      problem += expr <= upper
+
+  started = time.time()
+  problem.solve(pulp.PULP_CBC_CMD(msg=0, fracGap=gap, maxSeconds=time_limit))
+
+  # PuLP reports 'Not Solved' when CBC stops at the time limit, even if it
+  # found a solution. Use it if it's really a solution.
+  status = pulp.LpStatus[problem.status]
+  values = [v.value() for v in variables]
+  if status not in ['Optimal', 'Not Solved'] or None in values:
+    return start
+  if not ilp_feasible(model, values):
+    return start
+
+  if callback is not None:
+    callback(values, {
+      'objective': pulp.value(problem.objective),
+      'bound': None,
+      'elapsed': time.time() - started,
+    })
+  return values
+
+
+SOLVERS = {
+  'gurobi': solve_gurobi,
+  'cbc': solve_cbc,
+}
+
+################################################################################
+
+def lower_bound(wanted_parts, price_guide, stores=None, shipping_cost=10.0, method='simple'):
+  """A lower bound on the cost of all wanted parts plus shipping
+
+  No solution can cost less than this, so it tells how far from the best
+  solution any other solution could be.
+
+  Parameters
+  ----------
+  method : str
+      'simple' buys every part at the lowest price anyone sells it for and
+      pays shipping for the fewest stores the hardest to find part can be
+      bought from. 'lp' also solves the Linear Program relaxation of the ILP
+      (requires scipy) and keeps the higher of the two bounds.
+
+  Returns
+  -------
+  the bound, or infinity if the wanted parts can't be bought at all
+  """
+  guide = pricing.as_price_guide(price_guide)
+  wanted = wanted_quantities(guide, wanted_parts)
+  if wanted is None:
+    return INFINITY
+  quantities = store_set_quantities(guide, wanted, np.ones(len(guide.store_ids), dtype=bool))
+  if quantities is None:
+    return INFINITY
+  parts_cost = np.dot(quantities, guide.unit_cost)
+
+  # fewest stores needed to buy enough of each part
+  n_stores = 1 if wanted.sum() > 0 else 0
+  pair_quantity = guide.pair_quantity.tolist()
+  for (k, p) in iter_sellers(guide):
+    supply = np.cumsum(sorted((pair_quantity[i] for i in p), reverse=True))
+    n_stores = max(n_stores, int(np.searchsorted(supply, wanted[k])) + 1)
+  bound = parts_cost + shipping_cost * n_stores
+
+  if method == 'lp':
+    if stores is None:
+      stores = [{'store_id': s, 'minimum_buy': 0.0} for s in guide.store_ids]
+    model = ilp_model(wanted_parts, guide, stores, shipping_cost)
+    bound = max(bound, solve_lp(model))
+  return bound
+
+
+def iter_sellers(guide):
+  """Iterate over (part index, pairs selling it) for every part"""
+  sellers = {}
+  for (p, k) in enumerate(guide.pair_item.tolist()):
+    sellers.setdefault(k, []).append(p)
+  return sellers.iteritems()
+
+
+def solve_lp(model):
+  """Solve the Linear Program relaxation of an ILP model, returning the
+  optimal objective or infinity if it's infeasible"""
+  from scipy.optimize import linprog
+  from scipy.sparse import csr_matrix, vstack
+
+  n_variables = len(model['objective'])
+  A = csr_matrix((model['A_data'], model['A_indices'], model['A_indptr']),
+                 shape=(len(model['row_lower']), n_variables))
+
+  # linprog only takes A_ub x <= b_ub
+  lower = model['row_lower'] > -INFINITY
+  upper = model['row_upper'] < INFINITY
+  A_ub = vstack([-A[lower], A[upper]]).tocsr()
+  b_ub = np.concatenate([-model['row_lower'][lower], model['row_upper'][upper]])
+  bounds = zip(np.zeros(n_variables), model['var_upper'])
+
+  try:
+    result = linprog(model['objective'], A_ub=A_ub, b_ub=b_ub, bounds=bounds, method='highs')
+  except ValueError:
+    # scipy < 1.6 doesn't have HiGHS
+    result = linprog(model['objective'], A_ub=A_ub, b_ub=b_ub, bounds=bounds,
+                     method='interior-point', options={'sparse': True})
+  if result.status != 0:
+    return INFINITY
+  return result.fun
+
 
 ################################################################################
 
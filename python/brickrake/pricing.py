@@ -0,0 +1,212 @@
+"""
+A compact, array-backed representation of a price guide
+"""
+import numpy as np
+
+
+class PriceGuide(object):
+  """Lots available for purchase, stored as columns of NumPy arrays
+
+  Store ids and parts -- (item id, wanted color id) pairs -- are interned
+  into integer indices into `store_ids` and `items`. Lot i is described by
+
+    store[i]      index of the store selling it
+    item[i]       index of the part it is a substitute for
+    color_id[i]   its actual color
+    quantity[i]   quantity available
+    unit_cost[i]  cost per unit
+
+  Lots are grouped CSR-style, cheapest first within a group (ties go to the
+  lot that comes last in the price guide):
+
+    item_lots[item_offsets[k]:item_offsets[k + 1]]
+        lots of part k
+    store_lots[store_offsets[s]:store_offsets[s + 1]]
+        lots of store s, grouped by part
+
+  Each (store, part) group of store_lots is a "pair": pair p covers
+  store_lots[pair_offsets[p]:pair_offsets[p + 1]], sells pair_quantity[p] of
+  part pair_item[p], and store s owns pairs
+  store_pair_offsets[s]:store_pair_offsets[s + 1].
+  """
+
+  def __init__(self, store_ids, items, store, item, color_id, quantity, unit_cost):
+    store = np.asarray(store, dtype=np.int32)
+    item = np.asarray(item, dtype=np.int32)
+
+    # only keep stores that sell something, sorted by id so that algorithms
+    # enumerate (and break ties between) stores the same way on every run
+    used = np.unique(store)
+    by_id = dict( (store_ids[s], s) for s in used.tolist() )
+    self.store_ids = sorted(by_id.keys())
+    remap = np.zeros(len(store_ids), dtype=np.int32)
+    remap[[by_id[s] for s in self.store_ids]] = np.arange(len(self.store_ids), dtype=np.int32)
+
+    self.items = list(items)
+    self.store = remap[store]
+    self.item = item
+    self.color_id = np.asarray(color_id, dtype=np.int32)
+    self.quantity = np.asarray(quantity, dtype=np.int64)
+    self.unit_cost = np.asarray(unit_cost, dtype=np.float64)
+
+    self._index()
+
+    n_lots = len(self.store)
+    n_stores = len(self.store_ids)
+    n_items = len(self.items)
+    position = -np.arange(n_lots)
+
+    self.item_lots = np.lexsort((position, self.unit_cost, self.item))
+    self.item_offsets = offsets(self.item, n_items)
+
+    self.store_lots = np.lexsort((position, self.unit_cost, self.item, self.store))
+    self.store_offsets = offsets(self.store, n_stores)
+
+    pair_key = (self.store.astype(np.int64) * max(n_items, 1) + self.item)[self.store_lots]
+    starts = np.flatnonzero(np.concatenate([[True], pair_key[1:] != pair_key[:-1]])) \
+        if n_lots > 0 else np.zeros(0, dtype=int)
+    self.pair_offsets = np.concatenate([starts, [n_lots]]).astype(np.int64)
+    self.pair_store = self.store[self.store_lots[starts]]
+    self.pair_item = self.item[self.store_lots[starts]]
+    self.pair_quantity = np.add.reduceat(self.quantity[self.store_lots], starts) \
+        if n_lots > 0 else np.zeros(0, dtype=np.int64)
+    self.store_pair_offsets = offsets(self.pair_store, n_stores)
+
+  @classmethod
+  def from_lots(cls, lots):
+    """Build from a list of lots, as returned by io.load_price_guide"""
+    store_index = {}
+    item_index = {}
+    store = np.zeros(len(lots), dtype=np.int32)
+    item = np.zeros(len(lots), dtype=np.int32)
+    for (i, lot) in enumerate(lots):
+      store[i] = store_index.setdefault(lot['store_id'], len(store_index))
+      item[i] = item_index.setdefault((lot['item_id'], lot['wanted_color_id']), len(item_index))
+
+    store_ids = [None] * len(store_index)
+    for (s, i) in store_index.iteritems():
+      store_ids[i] = s
+    items = [None] * len(item_index)
+    for (k, i) in item_index.iteritems():
+      items[i] = k
+
+    return cls(
+        store_ids, items, store, item,
+        np.fromiter((e['color_id'] for e in lots), np.int32, len(lots)),
+        np.fromiter((e['quantity_available'] for e in lots), np.int64, len(lots)),
+        np.fromiter((e['cost_per_unit'] for e in lots), np.float64, len(lots)),
+    )
+
+  @classmethod
+  def from_arrays(cls, store_ids, items, arrays):
+    """Build from the arrays of another PriceGuide, by attribute name, without
+    copying or sorting them again. Used by io.load_price_guide_binary."""
+    guide = cls.__new__(cls)
+    guide.store_ids = list(store_ids)
+    guide.items = list(items)
+    for (name, value) in arrays.iteritems():
+      setattr(guide, name, value)
+    guide._index()
+    return guide
+
+  def _index(self):
+    self._store_index = dict( (s, i) for (i, s) in enumerate(self.store_ids) )
+    self._item_index = dict( (k, i) for (i, k) in enumerate(self.items) )
+
+  def __len__(self):
+    return len(self.store)
+
+  def lot(self, i):
+    """Lot i as a dict, in the format of io.load_price_guide"""
+    (item_id, wanted_color_id) = self.items[self.item[i]]
+    return {
+      'item_id': item_id,
+      'wanted_color_id': wanted_color_id,
+      'color_id': int(self.color_id[i]),
+      'store_id': self.store_ids[self.store[i]],
+      'quantity_available': int(self.quantity[i]),
+      'cost_per_unit': float(self.unit_cost[i]),
+    }
+
+  def lots(self):
+    """All lots as a list of dicts, in the format of io.load_price_guide"""
+    return [self.lot(i) for i in range(len(self))]
+
+  def store_index(self, store_id):
+    """Index of a store, or -1 if it sells nothing"""
+    return self._store_index.get(store_id, -1)
+
+  def wanted_items(self, wanted_parts):
+    """Index of the part for each wanted lot, or -1 if nobody sells it"""
+    return np.array(
+        [self._item_index.get((e['ItemID'], e['ColorID']), -1) for e in wanted_parts],
+        dtype=np.int32
+    )
+
+  def subset(self, mask):
+    """A price guide with only the lots where mask is True"""
+    return PriceGuide(
+        self.store_ids, self.items, self.store[mask], self.item[mask],
+        self.color_id[mask], self.quantity[mask], self.unit_cost[mask]
+    )
+
+  def select_stores(self, store_ids):
+    """A price guide with only the lots sold by some stores"""
+    allowed = np.zeros(len(self.store_ids), dtype=bool)
+    for s in store_ids:
+      if s in self._store_index:
+        allowed[self._store_index[s]] = True
+    return self.subset(allowed[self.store])
+
+
+def as_price_guide(price_guide):
+  """Convert a list of lots to a PriceGuide, if it isn't one already"""
+  if isinstance(price_guide, PriceGuide):
+    return price_guide
+  return PriceGuide.from_lots(price_guide)
+
+
+def offsets(keys, n):
+  """CSR offsets of sorted groups, for keys in range(n)"""
+  return np.concatenate([[0], np.cumsum(np.bincount(keys, minlength=n))]).astype(np.int64)
+
+
+def lot_key(lot):
+  """Lots with the same key are interchangeable"""
+  return (lot['store_id'], lot['item_id'], lot['wanted_color_id'], lot['color_id'], lot['cost_per_unit'])
+
+
+def diff(old, new):
+  """What changed between two price guides
+
+  Returns
+  -------
+  {'added': lots, 'removed': lots} where quantity_available is how much more
+  or less is available of a lot. A lot whose price changed is removed at its
+  old price and added at its new one.
+  """
+  totals = {}
+  order = []
+  for (sign, price_guide) in [(-1, old), (1, new)]:
+    if isinstance(price_guide, PriceGuide):
+      price_guide = price_guide.lots()
+    for lot in price_guide:
+      key = lot_key(lot)
+      if key not in totals:
+        totals[key] = 0
+        order.append(key)
+      totals[key] += sign * lot['quantity_available']
+
+  delta = {'added': [], 'removed': []}
+  for key in order:
+    if totals[key] != 0:
+      (store_id, item_id, wanted_color_id, color_id, cost_per_unit) = key
+      delta['added' if totals[key] > 0 else 'removed'].append({
+        'store_id': store_id,
+        'item_id': item_id,
+        'wanted_color_id': wanted_color_id,
+        'color_id': color_id,
+        'cost_per_unit': cost_per_unit,
+        'quantity_available': abs(totals[key]),
+      })
+  return delta
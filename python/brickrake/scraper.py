@@ -1,18 +1,45 @@
 """
 Functions for scraping bricklink.com
 """
+import Queue
 import re
+import sys
+import time
 import urllib
-
-from bs4 import BeautifulSoup as BS
+from HTMLParser import HTMLParser
 
 import color
 import utils
+import web
+
+
+BASE_URL = "http://www.bricklink.com"
+
+
+def price_guide(item, max_cost_quantile=None, pool=None, batch_size=1, parser='fast',
+                max_distance=None, max_colors=None, stats=None):
+  """Fetch pricing info for an item
 
+  Colors are searched in order of similarity to the wanted color until enough
+  inventory is found. If a thread pool is given, `batch_size` colors are
+  fetched concurrently at a time; the result is the same as searching them one
+  after another. `parser` is one of PARSERS.
 
-def price_guide(item, max_cost_quantile=None):
-  """Fetch pricing info for an item"""
+  Parameters
+  ----------
+  max_distance : float or None
+      don't search colors further than this from the wanted color, as
+      measured by color.distance
+  max_colors : int or None
+      maximum number of colors to search, including the wanted color
+  stats : dict or None
+      if given, 'tried' is set to the number of colors fetched and 'used' to
+      the number of colors inventory was found in
+  """
   results = []
+  if stats is None:
+    stats = {}
+  stats.update(tried=0, used=0)
 
   if (item['ItemTypeID'] == 'P' and 'stk0' in item['ItemID']) or \
       item['ItemTypeID'] == 'S' or \
@@ -21,140 +48,334 @@ def price_guide(item, max_cost_quantile=None):
     color_ids = [0]
   else:
     # a normal item
-    color_ids = color.similar_to(item['ColorID'])
-
-  for c in color_ids:
-    # perform HTTP request
-    parameters = {
-        'itemType': item['ItemTypeID'],
-        'itemNo': item['ItemID'],
-        'itemSeq': 1,
-        'colorId': c,
-        'v': 'P',
-        'priceGroup': 'Y',
-        'prDec': 2
-    }
-    url = "http://www.bricklink.com/catalogPG.asp?" + urllib.urlencode(parameters)
-    html = urllib.urlopen(url).read()
-
-    # parse page
-    page = BS(html)
-
-    if len(page.find_all(text='Currently Available')) == 0:
-      # not available in this color :(
-      continue
-    else:
-
-      # newly found inventory
-      new = []
-
-      for td in page.find_all('td'):
-        if td.find('a', recursive=False, href=re.compile('/store.asp')) is not None:
-          # find the td element with a link to a store. Its siblings contain
-          # the interesting bits like price and quantity available
-          store_url = td.find('a')['href']
-          store_id = int(utils.get_params(store_url)['sID'])
-          quantity = int(td.next_sibling.text)
-          cost_per_unit = float(re.findall('[0-9.]+',
-                                td.next_sibling.next_sibling.text)[0])
-
-          new.append({
-            'item_id': item['ItemID'],
-            'wanted_color_id': item['ColorID'],
-            'color_id': c,
-            'store_id': store_id,
-            'quantity_available': quantity,
-            'cost_per_unit': cost_per_unit
-          })
-
-      # remove items that cost too much
-      if max_cost_quantile is not None and max_cost_quantile < 1.0:
-        observed_prices = [e['quantity_available'] * [e['cost_per_unit']] for e in new]
-        observed_prices = list(sorted(utils.flatten(observed_prices)))
-        if len(observed_prices) > 0:
-          i = utils.quantile(len(observed_prices)-1, max_cost_quantile)
-          max_price = observed_prices[i]
-          new = filter(lambda x: x['cost_per_unit'] <= max_price, new)
-
-      # add what's left to the considered inventory
-      results.extend(new)
-
-    if sum(e['quantity_available'] for e in results) >= item['Qty']:
-      # stop early, we've got everything we need
-      return results
+    color_ids = color.similar_to(item['ColorID'], k=max_colors, max_distance=max_distance)
+
+  fetch_page = lambda c: web.fetch(price_guide_url(item, c))
+  fetch_pages = pool.map if pool is not None else map
+
+  for start in range(0, len(color_ids), batch_size):
+    # perform HTTP requests
+    batch = color_ids[start:start + batch_size]
+    pages = fetch_pages(fetch_page, batch)
+    stats['tried'] += len(batch)
+
+    for (c, html) in zip(batch, pages):
+      # parse page
+      lots = parse_price_guide(html, parser)
+
+      if lots is None:
+        # not available in this color :(
+        continue
+      else:
+
+        # newly found inventory
+        new = [{
+          'item_id': item['ItemID'],
+          'wanted_color_id': item['ColorID'],
+          'color_id': c,
+          'store_id': store_id,
+          'quantity_available': quantity,
+          'cost_per_unit': cost_per_unit
+        } for (store_id, quantity, cost_per_unit) in lots]
+
+        # remove items that cost too much
+        if max_cost_quantile is not None and max_cost_quantile < 1.0:
+          observed_prices = [e['quantity_available'] * [e['cost_per_unit']] for e in new]
+          observed_prices = list(sorted(utils.flatten(observed_prices)))
+          if len(observed_prices) > 0:
+            i = utils.quantile(len(observed_prices)-1, max_cost_quantile)
+            max_price = observed_prices[i]
+            new = filter(lambda x: x['cost_per_unit'] <= max_price, new)
+
+        # add what's left to the considered inventory
+        results.extend(new)
+        if len(new) > 0:
+          stats['used'] += 1
+
+      if sum(e['quantity_available'] for e in results) >= item['Qty']:
+        # stop early, we've got everything we need. Pages fetched for the
+        # remaining colors in this batch are thrown away.
+        return results
 
   return results
 
 
-def store_info(country=None):
+def parse_price_guide(html, parser='fast'):
+  """Extract lots for sale from a catalogPG.asp page
+
+  Parameters
+  ----------
+  html : str
+      contents of the page
+  parser : str
+      'bs4' builds a full Beautiful Soup tree. 'fast' only scans the page for
+      table cells, and is several times faster.
+
+  Returns
+  -------
+  list of (store id, quantity available, cost per unit), or None if the part
+  isn't available in this color
+  """
+  return PARSERS[parser](html)
+
+
+def parse_price_guide_bs4(html):
+  """parse_price_guide() using Beautiful Soup"""
+  from bs4 import BeautifulSoup as BS
+
+  page = BS(html, utils.HTML_PARSER)
+  if len(page.find_all(text='Currently Available')) == 0:
+    return None
+
+  lots = []
+  for td in page.find_all('td'):
+    if td.find('a', recursive=False, href=re.compile('/store.asp')) is not None:
+      # find the td element with a link to a store. Its siblings contain
+      # the interesting bits like price and quantity available
+      store_url = td.find('a')['href']
+      store_id = int(utils.get_params(store_url)['sID'])
+      quantity = int(td.next_sibling.text)
+      cost_per_unit = float(re.findall('[0-9.]+',
+                            td.next_sibling.next_sibling.text)[0])
+      lots.append((store_id, quantity, cost_per_unit))
+  return lots
+
+
+# an innermost table cell, the start of a link, and any tag
+CELL = re.compile(r'<td\b[^>]*>((?:(?!<td\b|</td>).)*)</td>\s*', re.I | re.S)
+LINK = re.compile(r'<a\b[^>]*?\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+TAG = re.compile(r'<(/?)([a-z0-9]*)[^>]*?(/?)>', re.I)
+VOID_TAGS = set(['area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'param', 'wbr'])
+AVAILABLE = re.compile(r'>Currently Available<')
+
+
+def parse_price_guide_fast(html):
+  """parse_price_guide() using regular expressions
+
+  Lots are listed in a table whose rows are a cell with a link to the store,
+  a cell with the quantity and a cell with the price. Only innermost cells
+  are looked at, so the layout tables around them don't matter.
+  """
+  if AVAILABLE.search(html) is None:
+    return None
+
+  unescape = HTMLParser().unescape
+  text = lambda fragment: unescape(TAG.sub('', fragment))
+
+  cells = list(CELL.finditer(html))
+  lots = []
+  for (i, cell) in enumerate(cells[:-2]):
+    # the link must be a child of the cell, not nested in another tag
+    content = cell.group(1)
+    link = LINK.search(content)
+    if link is None or depth(content[:link.start()]) != 0:
+      continue
+    store_url = unescape(link.group(1) or link.group(2) or link.group(3))
+    if '/store.asp' not in store_url:
+      continue
+
+    # the quantity and price are in the next two cells
+    (quantity, price) = cells[i + 1:i + 3]
+    if quantity.start() != cell.end() or price.start() != quantity.end():
+      continue
+    lots.append((
+      int(utils.get_params(store_url)['sID']),
+      int(text(quantity.group(1))),
+      float(re.findall('[0-9.]+', text(price.group(1)))[0]),
+    ))
+  return lots
+
+
+def depth(fragment):
+  """How many more elements an HTML fragment opens than it closes"""
+  result = 0
+  for (closing, name, self_closing) in TAG.findall(fragment):
+    if closing:
+      result -= 1
+    elif name and not self_closing and name.lower() not in VOID_TAGS:
+      result += 1
+  return result
+
+
+PARSERS = {
+  'bs4': parse_price_guide_bs4,
+  'fast': parse_price_guide_fast,
+}
+
+
+def price_guide_url(item, color_id):
+  """URL of the price guide page for an item in a particular color"""
+  parameters = {
+      'itemType': item['ItemTypeID'],
+      'itemNo': item['ItemID'],
+      'itemSeq': 1,
+      'colorId': color_id,
+      'v': 'P',
+      'priceGroup': 'Y',
+      'prDec': 2
+  }
+  return BASE_URL + "/catalogPG.asp?" + urllib.urlencode(parameters)
+
+
+def store_info(country=None, pool=None, skip=()):
   """Fetch metadata for all stores"""
-  browse_page = utils.beautiful_soup('http://www.bricklink.com/browse.asp')
+  return list(iter_store_info(country, pool, skip))
+
+
+def update_store_info(stores, ttl, country=None, pool=None):
+  """Refresh metadata fetched by store_info, only fetching what changed
+
+  Stores fetched less than `ttl` seconds ago are kept as they are, stores that
+  are new or older than that are fetched again, and stores no longer listed
+  on BrickLink are dropped. If `country` is given, stores from other
+  countries are kept as they are.
+
+  Yields (store, fetched) pairs, where fetched is True if the store was just
+  fetched and False if it was kept. Stores that were fetched come out first,
+  as soon as they're done, followed by the ones that were kept.
+  """
+  now = time.time()
+  other = [s for s in stores if country is not None and s['country_id'] != country]
+  fresh = [s for s in stores if (country is None or s['country_id'] == country)
+           and now - s.get('fetched_at', 0.0) < ttl]
+  listed = set()
+
+  for entry in iter_store_info(country, pool, skip=[s['seller_name'] for s in fresh], listed=listed):
+    yield (entry, True)
+
+  for s in fresh:
+    if s['seller_name'] in listed:
+      yield (s, False)
+  for s in other:
+    yield (s, False)
+
+
+def iter_store_info(country=None, pool=None, skip=(), listed=None):
+  """Fetch metadata for all stores, yielding each store as soon as it's done
+
+  If a thread pool is given, country pages and stores are fetched
+  concurrently, and stores come out in the order they finish. Stores whose
+  seller name is in `skip` aren't fetched again. If `listed` is a set, the
+  seller name of every store found is added to it, skipped or not.
+  """
+  browse_page = utils.beautiful_soup(BASE_URL + '/browse.asp')
   country_links = (
     browse_page
     .find(text='Stores:').parent.parent.next_sibling
     .find_all('a', href=re.compile('countryID'))
   )
 
-  result = []
+  # skip other countries if we're only gathering data on one country
+  country_urls = [
+    country_link['href'] for country_link in country_links
+    if country is None or utils.get_params(country_link['href'])['countryID'] == country
+  ]
 
-  for country_link in country_links:
-    country_name = country_link.text
-    country_id = utils.get_params(country_link['href'])['countryID']
+  skip = set(skip)
+  seen = set()
 
-    # skip this country link if we're only gathering data on one country
-    if country is not None and country_id != country:
-      continue
+  def new_stores(store_urls):
+    for store_url in store_urls:
+      params = utils.get_params(store_url)
+      if 'p' not in params:
+        raise ValueError('Store link without a seller name: %s' % (store_url,))
+      seller_name = params['p']
+      if listed is not None:
+        listed.add(seller_name)
+      if store_url not in seen and seller_name not in skip:
+        seen.add(store_url)
+        yield store_url
 
-    country_page = utils.beautiful_soup('http://www.bricklink.com' + country_link['href'])
-    store_links = country_page.find_all('a', href=re.compile('store.asp'))
-
-    for store_link in store_links:
-      store_page = utils.beautiful_soup('http://www.bricklink.com' + '/' + store_link['href'])
-      params = utils.get_params(store_page.find('frame', src=re.compile('^storeTop.asp'))['src'])
-
-      store_name = params['storeName']
-      store_id = params['uID']
-      country_name = params['cn']
-      country_id = params['c']
-      seller_name = params['p_seller']
-      feedback = params['p_feedback']
-
-      store_splash = utils.beautiful_soup("http://www.bricklink.com/storeSplash.asp?uID=" + store_id)
-      min_buy_elem = store_splash.find(text="Minimum Buy:")
-      if min_buy_elem is not None:
-        min_buy = min_buy_elem.parent.parent.parent.parent.next_sibling.find("font").text
-        try:
-          min_buy = re.search("US \$([0-9.]+)", min_buy).group(1)
-          min_buy = float(min_buy)
-        except AttributeError:
-          # there's a minimum buy in a foreign currency :(
-          continue
-      else:
-        min_buy = 0.0
+  if pool is None:
+    for country_url in country_urls:
+      for store_url in new_stores(country_store_urls(country_url)):
+        yield store_entry(store_url)
+    return
 
-      ships_to_elem = store_splash.find(text="Store Ships To:")
-      if ships_to_elem is not None:
-        ships = ships_to_elem.parent.parent.parent.parent.next_sibling.find_all(text=True)
-        ships = map(lambda x: unicode(x), ships)
-      else:
-        ships = []
+  # stores are fetched as soon as their country's page is in. Finished
+  # stores are put in a queue, along with the exception raised if any.
+  finished = Queue.Queue()
 
+  def fetch_store(store_url):
+    try:
+      finished.put((store_entry(store_url), None))
+    except Exception:
+      finished.put((None, sys.exc_info()))
 
-      entry = {
-        'store_name': store_name,
-        'store_id': int(store_id),
-        'country_name': country_name,
-        'country_id': country_id,
-        'seller_name': seller_name,
-        'feedback': int(feedback),
-        'minimum_buy': min_buy,
-        'ships': ships
-      }
-      print entry
+  def collect():
+    (entry, error) = finished.get()
+    if error is not None:
+      raise error[0], error[1], error[2]
+    return entry
 
-      result.append(entry)
+  n_pending = 0
+  for store_urls in pool.imap_unordered(country_store_urls, country_urls):
+    for store_url in new_stores(store_urls):
+      pool.apply_async(fetch_store, (store_url,))
+      n_pending += 1
+    while not finished.empty():
+      n_pending -= 1
+      yield collect()
 
-  return result
+  while n_pending > 0:
+    n_pending -= 1
+    yield collect()
+
+
+def country_store_urls(country_url):
+  """Links to every store on a country's page"""
+  country_page = utils.beautiful_soup(BASE_URL + country_url)
+  return [store_link['href'] for store_link in
+          country_page.find_all('a', href=re.compile('store.asp'))]
+
+
+def store_entry(store_url):
+  """Metadata for a single store
+
+  A minimum buy in a currency other than US dollars can't be compared to
+  prices, so it's recorded as None.
+  """
+  store_page = utils.beautiful_soup(BASE_URL + '/' + store_url)
+  params = utils.get_params(store_page.find('frame', src=re.compile('^storeTop.asp'))['src'])
+
+  store_name = params['storeName']
+  store_id = params['uID']
+  country_name = params['cn']
+  country_id = params['c']
+  seller_name = params['p_seller']
+  feedback = params['p_feedback']
+
+  store_splash = utils.beautiful_soup(BASE_URL + "/storeSplash.asp?uID=" + store_id)
+  min_buy_elem = store_splash.find(text="Minimum Buy:")
+  if min_buy_elem is not None:
+    min_buy = min_buy_elem.parent.parent.parent.parent.next_sibling.find("font").text
+    try:
+      min_buy = re.search("US \$([0-9.]+)", min_buy).group(1)
+      min_buy = float(min_buy)
+    except AttributeError:
+      # there's a minimum buy in a foreign currency :(
+      min_buy = None
+  else:
+    min_buy = 0.0
+
+  ships_to_elem = store_splash.find(text="Store Ships To:")
+  if ships_to_elem is not None:
+    ships = ships_to_elem.parent.parent.parent.parent.next_sibling.find_all(text=True)
+    ships = map(lambda x: unicode(x), ships)
+  else:
+    ships = []
+
+  return {
+    'store_name': store_name,
+    'store_id': int(store_id),
+    'country_name': country_name,
+    'country_id': country_id,
+    'seller_name': seller_name,
+    'feedback': int(feedback),
+    'minimum_buy': min_buy,
+    'ships': ships,
+    'fetched_at': time.time(),
+  }
 
 ALL_COUNTRIES = [
   "Argentina",
@@ -0,0 +1,66 @@
+"""
+Tests for brickrake.cache
+"""
+import os
+import shutil
+import tempfile
+
+from brickrake.cache import *
+
+
+def with_cache(test):
+  def wrapped():
+    folder = tempfile.mkdtemp()
+    try:
+      test(os.path.join(folder, 'cache.sqlite'))
+    finally:
+      shutil.rmtree(folder)
+  wrapped.__name__ = test.__name__
+  return wrapped
+
+
+def test_normalize_url():
+  assert (normalize_url('http://WWW.bricklink.com/catalogPG.asp?itemNo=3001&colorId=1') ==
+          normalize_url('http://www.bricklink.com/catalogPG.asp?colorId=1&itemNo=3001'))
+  assert (normalize_url('http://www.bricklink.com/catalogPG.asp?colorId=1') !=
+          normalize_url('http://www.bricklink.com/catalogPG.asp?colorId=2'))
+
+
+@with_cache
+def test_hit_and_miss(path):
+  cache = ResponseCache(path)
+  assert cache.get('http://a.com/x?b=1&a=2') is None
+  cache.put('http://a.com/x?b=1&a=2', '\xff<html>')
+  assert cache.get('http://a.com/x?a=2&b=1') == '\xff<html>'
+  assert cache.stats()['hits'] == 1
+  assert cache.stats()['misses'] == 1
+  cache.close()
+
+  # pages survive between runs
+  cache = ResponseCache(path)
+  assert cache.get('http://a.com/x?a=2&b=1') == '\xff<html>'
+  assert cache.stats()['bytes'] == 7
+
+
+@with_cache
+def test_ttl(path):
+  cache = ResponseCache(path, ttl=0.0)
+  cache.put('http://a.com/', 'page')
+  assert cache.get('http://a.com/') is None
+  assert cache.stats()['entries'] == 0
+
+
+@with_cache
+def test_lru_eviction(path):
+  cache = ResponseCache(path, max_bytes=10)
+  cache.put('http://a.com/1', '1111')
+  cache.put('http://a.com/2', '2222')
+  assert cache.get('http://a.com/1') == '1111'
+  cache.put('http://a.com/3', '3333')
+
+  # page 2 was used least recently
+  assert cache.get('http://a.com/2') is None
+  assert cache.get('http://a.com/1') == '1111'
+  assert cache.get('http://a.com/3') == '3333'
+  assert cache.stats()['evictions'] == 1
+  assert cache.stats()['bytes'] == 8
@@ -0,0 +1,59 @@
+"""
+Tests for brickrake.color
+"""
+import json
+
+from brickrake import color
+
+
+def test_index_up_to_date():
+  with open(color.INDEX_PATH) as f:
+    saved = json.load(f)
+  assert saved['version'] == color.INDEX_VERSION
+  assert saved['colors'] == color.colors_checksum()
+
+
+def test_similar_to():
+  for color_id in [1, 5, 11, 85]:
+    target = color.colors()[color_id]['lab']
+    expected = sorted(
+        (id != color_id, color.distance(c['lab'], target), id)
+        for (id, c) in color.colors().items()
+    )
+    assert color.similar_to(color_id) == [id for (itself, d, id) in expected]
+
+  # unknown color is treated as light grey
+  assert color.similar_to(0) == color.similar_to(9)
+
+  # a color is always its own closest color, even if others are identical
+  for color_id in color.colors():
+    assert color.similar_to(color_id, k=1) == [color_id]
+  assert color.neighbors(123, k=2) == [(123, 0.0), (1, 0.0)]
+
+
+def test_neighbors():
+  everything = color.neighbors(5)
+  assert len(everything) == len(color.colors())
+  assert everything[0] == (5, 0.0)
+
+  assert color.neighbors(5, k=3) == everything[:3]
+
+  max_distance = everything[10][1]
+  nearby = color.neighbors(5, max_distance=max_distance)
+  assert all(d <= max_distance for (id, d) in nearby)
+  assert nearby == everything[:len(nearby)]
+  assert len(nearby) >= 11
+
+  assert color.neighbors(5, k=2, max_distance=max_distance) == everything[:2]
+
+
+def test_distances():
+  labs = [c['lab'] for c in color.colors().values()][:40]
+  matrix = color.distances(labs, labs[:25])
+  assert matrix.shape == (40, 25)
+  for (i, lab1) in enumerate(labs):
+    for (j, lab2) in enumerate(labs[:25]):
+      assert abs(matrix[i, j] - color.distance(lab1, lab2)) < 1e-8
+
+  # a single color against many
+  assert color.distances(labs[3], labs).shape == (1, 40)
@@ -0,0 +1,27 @@
+"""
+Tests that importing brickrake stays cheap
+"""
+import subprocess
+import sys
+
+
+def loaded_by(statement, modules):
+  """Which of `modules` get imported by running `statement`"""
+  script = ("import sys; %s; "
+            "print ','.join(m for m in %r if m in sys.modules)") % (statement, modules)
+  output = subprocess.check_output([sys.executable, '-c', script]).strip()
+  return [m for m in output.split(',') if len(m) > 0]
+
+
+def test_lazy_imports():
+  heavy = ['bs4', 'numpy', 'pandas', 'colormath', 'gurobipy']
+  assert loaded_by('import brickrake.color', heavy) == []
+  assert loaded_by('import brickrake.io', heavy) == []
+  assert loaded_by('import brickrake.utils', heavy) == []
+  assert loaded_by('import brickrake.scraper', heavy) == []
+
+  # the minimizers work on NumPy arrays, but solvers are only loaded when used
+  assert loaded_by('import brickrake.minimizer', heavy) == ['numpy']
+
+  # looking up similar colors uses the precomputed index
+  assert loaded_by('import brickrake.color as c; c.similar_to(5)', heavy) == []
@@ -0,0 +1,162 @@
+"""
+Tests for brickrake.io
+"""
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from brickrake import io, pricing
+from brickrake.io import *
+
+
+LOTS = [
+  {'item_id': '3001', 'wanted_color_id': 1, 'color_id': 1,
+   'store_id': 5, 'quantity_available': 10, 'cost_per_unit': 0.1},
+  {'item_id': '3002', 'wanted_color_id': 2, 'color_id': 3,
+   'store_id': 6, 'quantity_available': 4, 'cost_per_unit': 0.25},
+]
+
+
+def test_load_price_guide():
+  # a JSON list
+  f = StringIO()
+  save_price_guide(f, LOTS)
+  f.seek(0)
+  assert load_price_guide(f) == LOTS
+
+  # one lot per line
+  f = StringIO('\n'.join(json.dumps(lot) for lot in LOTS) + '\n')
+  assert load_price_guide(f) == LOTS
+
+
+def test_append_price_guide():
+  folder = tempfile.mkdtemp()
+  try:
+    path = os.path.join(folder, 'price_guide.json')
+    with open(path, 'wb') as f:
+      append_price_guide(f, LOTS[:1])
+      append_price_guide(f, [])
+      append_price_guide(f, LOTS[1:])
+    assert load_price_guide(open(path)) == LOTS
+
+    # the last lot was being written when the program died
+    with open(path, 'ab') as f:
+      f.write(json.dumps(LOTS[0])[:20])
+    assert load_price_guide(open(path)) == LOTS
+  finally:
+    shutil.rmtree(folder)
+
+
+def test_corrupt_price_guide():
+  f = StringIO(json.dumps(LOTS[0])[:20] + '\n' + json.dumps(LOTS[1]) + '\n')
+  try:
+    load_price_guide(f)
+    assert False
+  except ValueError:
+    pass
+
+
+def test_binary_price_guide():
+  folder = tempfile.mkdtemp()
+  try:
+    for lots in [LOTS, LOTS[:1], []]:
+      path = os.path.join(folder, 'price_guide.bin')
+      with open(path, 'wb') as f:
+        save_price_guide_binary(f, lots)
+      assert is_binary_price_guide(path)
+
+      guide = load_price_guide_binary(path)
+      assert sorted(guide.lots()) == sorted(lots)
+      expected = pricing.PriceGuide.from_lots(lots)
+      for (name, dtype) in io.BINARY_COLUMNS:
+        assert getattr(guide, name).tolist() == getattr(expected, name).tolist(), name
+
+    # files from before the indices were saved
+    old_version = (io.BINARY_VERSION, io.BINARY_COLUMNS)
+    io.BINARY_VERSION = 1
+    io.BINARY_COLUMNS = io.BINARY_COLUMNS[:5]
+    try:
+      with open(path, 'wb') as f:
+        save_price_guide_binary(f, LOTS)
+    finally:
+      (io.BINARY_VERSION, io.BINARY_COLUMNS) = old_version
+    guide = load_price_guide_binary(path)
+    assert sorted(guide.lots()) == sorted(LOTS)
+    assert guide.store_lots.tolist() == pricing.PriceGuide.from_lots(LOTS).store_lots.tolist()
+
+    path = os.path.join(folder, 'price_guide.json')
+    with open(path, 'w') as f:
+      save_price_guide(f, LOTS)
+    assert not is_binary_price_guide(path)
+  finally:
+    shutil.rmtree(folder)
+
+
+BSX = """<?xml version="1.0" encoding="UTF-8"?>
+<BrickStoreXML>
+  <Inventory>
+    <Item><ItemID>3001</ItemID><ItemName>Brick 2 x 4</ItemName><ColorID>5</ColorID><Qty>4</Qty></Item>
+    <Item><ItemID>3002</ItemID><ItemName>Brick 2 x 3</ItemName><ColorID>1</ColorID><Qty>2</Qty></Item>
+    <Item><ItemID>3001</ItemID><ItemName>Brick 2 x 4</ItemName><ColorID>5</ColorID><Qty>6</Qty></Item>
+  </Inventory>
+</BrickStoreXML>
+"""
+
+BRICKLINK_XML = """<INVENTORY>
+  <ITEM><ITEMTYPE>P</ITEMTYPE><ITEMID>3002</ITEMID><COLOR>1</COLOR><MINQTY>3</MINQTY></ITEM>
+  <ITEM><ITEMTYPE>P</ITEMTYPE><ITEMID>3003</ITEMID><COLOR>11</COLOR><MINQTY>1</MINQTY></ITEM>
+</INVENTORY>
+"""
+
+
+def test_store_metadata():
+  stores = [
+    {'store_id': 1, 'seller_name': 'alice', 'minimum_buy': 0.0, 'ships': []},
+    {'store_id': 2, 'seller_name': 'bob', 'minimum_buy': 10.0, 'ships': ['USA']},
+  ]
+  f = StringIO()
+  save_store_metadata(f, stores)
+  assert load_store_metadata(StringIO(f.getvalue())) == stores
+
+  folder = tempfile.mkdtemp()
+  try:
+    path = os.path.join(folder, 'stores.json')
+    with open(path, 'wb') as f:
+      append_store_metadata(f, stores[:1])
+      append_store_metadata(f, stores[1:])
+    assert load_store_metadata(open(path)) == stores
+  finally:
+    shutil.rmtree(folder)
+
+
+def test_load_bsx():
+  # duplicate lots are merged, in the order they first appear
+  assert load_bsx(StringIO(BSX)) == [
+    {'ItemID': '3001', 'ItemName': 'Brick 2 x 4', 'ColorID': 5, 'Qty': 10},
+    {'ItemID': '3002', 'ItemName': 'Brick 2 x 3', 'ColorID': 1, 'Qty': 2},
+  ]
+
+
+def test_load_xml():
+  parts = load_xml(StringIO(BRICKLINK_XML))
+  assert [(e['ItemID'], e['ColorID'], e['Qty']) for e in parts] == [('3002', 1, 3), ('3003', 11, 1)]
+  assert parts[1]['ItemName'] == '3003'
+  assert parts[1]['ColorName'] == 'Black'
+
+
+def test_load_parts_lists():
+  folder = tempfile.mkdtemp()
+  try:
+    paths = [os.path.join(folder, 'a.BSX'), os.path.join(folder, 'b.xml')]
+    for (path, contents) in zip(paths, [BSX, BRICKLINK_XML]):
+      with open(path, 'w') as f:
+        f.write(contents)
+
+    parts = load_parts_lists(paths)
+    assert [(e['ItemID'], e['ColorID'], e['Qty']) for e in parts] == [
+      ('3001', 5, 10), ('3002', 1, 5), ('3003', 11, 1)
+    ]
+  finally:
+    shutil.rmtree(folder)
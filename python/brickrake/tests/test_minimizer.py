@@ -1,8 +1,10 @@
 """
 Tests for brickrake.minimizer
 """
-from unittest import TestCase
+import random
+from unittest import SkipTest, TestCase
 
+from brickrake import pricing
 from brickrake.minimizer import *
 
 
@@ -158,5 +160,264 @@ def test_brute_force():
   assert brute_force(WANTED_PARTS, JUST_RIGHT, 2) == [{
     'cost': sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION),
     'allocation': ALLOCATION,
-    'store_ids': ('two', 'one')
+    'store_ids': ('one', 'two')
   }]
+
+
+def test_brute_force_n_best():
+  wanted = [{'ItemID': '1', 'ColorID': 1, 'Qty': 10, 'ItemName': 'Item1'}]
+  price_guide = [
+    {'item_id': '1', 'wanted_color_id': 1, 'color_id': 1, 'store_id': s,
+     'quantity_available': 10, 'cost_per_unit': price}
+    for (s, price) in [(1, 0.3), (2, 0.1), (3, 0.5), (4, 0.2)]
+  ]
+  everything = brute_force(wanted, price_guide, 1)
+  assert len(everything) == 4
+
+  cheapest = brute_force(wanted, price_guide, 1, n_best=2)
+  assert [e['store_ids'] for e in cheapest] == [(2,), (4,)]
+  assert cheapest == sorted(everything, key=lambda x: x['cost'])[:2]
+
+  # with 2 stores, the cheapest is always to buy everything from store 2
+  assert [e['cost'] for e in brute_force(wanted, price_guide, 2, n_best=3)] == [1.0, 1.0, 1.0]
+
+
+def test_greedy():
+  solution = greedy(WANTED_PARTS, JUST_RIGHT)[0]
+  assert [(e['store_id'], e['item_id'], e['color_id'], e['quantity']) for e in solution['allocation']] == [
+    ('one', '123', 1, 100),
+    ('one', '123', 3, 30),
+    ('one', '456', 80, 10),
+    ('two', '123', 3, 20),
+  ]
+  assert solution['cost'] == sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION)
+  assert sorted(solution['store_ids']) == ['one', 'two']
+  assert is_valid_solution(WANTED_PARTS, solution['allocation'])
+
+  # the wanted parts list isn't modified
+  assert [e['Qty'] for e in WANTED_PARTS] == [100, 50, 10]
+
+  # not enough inventory
+  solution = greedy(WANTED_PARTS, NOT_ENOUGH_INVENTORY)[0]
+  assert unsatisified(WANTED_PARTS, solution['allocation']) == {('456', 80): 5}
+
+
+def test_local_search():
+  # store 'two' sells enough of everything, so greedy only uses it. Store
+  # 'one' is so much cheaper that it's worth paying to ship from it too.
+  two = lambda lot, quantity, cost: dict(lot, store_id='two', quantity_available=quantity, cost_per_unit=cost)
+  price_guide = JUST_RIGHT + [
+    two(JUST_RIGHT[0], 100, 0.50),
+    two(JUST_RIGHT[2], 25, 0.30),
+    two(JUST_RIGHT[3], 10, 0.90),
+  ]
+  stores = [
+    {'store_id': 'one', 'minimum_buy': 0.0},
+    {'store_id': 'two', 'minimum_buy': 0.0},
+  ]
+  assert greedy(WANTED_PARTS, price_guide)[0]['store_ids'] == ['two']
+
+  solution = local_search(WANTED_PARTS, price_guide, stores, shipping_cost=10.0)[0]
+  assert is_valid_solution(WANTED_PARTS, solution['allocation'], stores)
+  assert sorted(solution['store_ids']) == ['one', 'two']
+  assert abs(solution['cost'] - (100 * 0.05 + 30 * 0.10 + 20 * 0.25 + 10 * 0.20)) < 1e-6
+  assert solution['local_search']['iterations'] == 1
+
+  # not enough would be spent at store 'one' to reach its minimum buy
+  stores[0]['minimum_buy'] = 20.0
+  solution = local_search(WANTED_PARTS, price_guide, stores, shipping_cost=10.0)[0]
+  assert solution['store_ids'] == ['two']
+
+
+STORES = [
+  {'store_id': 'one', 'minimum_buy': 0.0},
+  {'store_id': 'two', 'minimum_buy': 0.0},
+]
+
+
+def test_ilp():
+  try:
+    import pulp
+  except ImportError:
+    raise SkipTest('PuLP is not installed')
+
+  solution = ilp(WANTED_PARTS, JUST_RIGHT, STORES, shipping_cost=10.0, solver='cbc')[0]
+  assert is_valid_solution(WANTED_PARTS, solution['allocation'], STORES)
+  assert abs(solution['cost'] - sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION)) < 1e-6
+  assert sorted(solution['store_ids']) == ['one', 'two']
+
+  # nobody sells the last part
+  assert ilp(WANTED_PARTS, MISSING_PART, STORES, solver='cbc') == []
+
+  # every new best solution is reported
+  incumbents = []
+  solution = ilp(WANTED_PARTS, JUST_RIGHT, STORES, shipping_cost=10.0, solver='cbc',
+                 gap=0.0, time_limit=60, callback=lambda *args: incumbents.append(args))[0]
+  (last, info) = incumbents[-1]
+  assert last['allocation'] == solution['allocation']
+  assert abs(info['objective'] - (solution['cost'] + 10.0 * len(solution['store_ids']))) < 1e-6
+
+
+def test_lower_bound():
+  best = sum(x['cost_per_unit'] * x['quantity'] for x in ALLOCATION) + 2 * 10.0
+
+  # part 123 in color 2 can't be bought from fewer than 2 stores
+  assert abs(lower_bound(WANTED_PARTS, JUST_RIGHT, STORES) - best) < 1e-6
+  assert lower_bound(WANTED_PARTS, MISSING_PART, STORES) == INFINITY
+  assert lower_bound(WANTED_PARTS, NOT_ENOUGH_INVENTORY, STORES) == INFINITY
+
+  try:
+    import scipy
+  except ImportError:
+    raise SkipTest('scipy is not installed')
+  assert abs(lower_bound(WANTED_PARTS, JUST_RIGHT, STORES, method='lp') - best) < 1e-6
+
+
+def test_ilp_time_limit():
+  try:
+    import pulp
+  except ImportError:
+    raise SkipTest('PuLP is not installed')
+
+  # too big to prove optimal in a second, but a solution is found by then
+  r = random.Random(1)
+  wanted = [{'ItemID': str(i), 'ColorID': r.choice([1, 5]), 'Qty': r.randint(1, 20)}
+            for i in range(120)]
+  price_guide = []
+  for j in range(6000):
+    part = r.choice(wanted)
+    price_guide.append({
+      'item_id': part['ItemID'], 'wanted_color_id': part['ColorID'], 'color_id': part['ColorID'],
+      'store_id': r.randint(1, 150), 'quantity_available': r.randint(1, 20),
+      'cost_per_unit': round(r.uniform(0.01, 1.0), 2),
+    })
+  stores = [{'store_id': s, 'minimum_buy': 0.0} for s in range(1, 151)]
+
+  solutions = ilp(wanted, price_guide, stores, solver='cbc', gap=0.0, time_limit=1)
+  assert len(solutions) == 1
+  assert is_valid_solution(wanted, solutions[0]['allocation'], stores)
+
+
+def test_ilp_alternatives():
+  try:
+    import pulp
+  except ImportError:
+    raise SkipTest('PuLP is not installed')
+
+  # store 'three' sells everything store 'one' does, for a little more
+  price_guide = JUST_RIGHT + [dict(lot, store_id='three', cost_per_unit=lot['cost_per_unit'] + 0.01)
+                              for lot in JUST_RIGHT if lot['store_id'] == 'one']
+  stores = STORES + [{'store_id': 'three', 'minimum_buy': 0.0}]
+
+  solutions = ilp_alternatives(WANTED_PARTS, price_guide, stores, 5, solver='cbc', gap=0.0)
+  assert [sorted(s['store_ids']) for s in solutions] == [
+    ['one', 'three'], ['one', 'two'], ['three', 'two'], ['one', 'three', 'two']
+  ]
+  totals = [s['cost'] + 10.0 * len(s['store_ids']) for s in solutions]
+  assert totals == sorted(totals)
+  for s in solutions:
+    assert is_valid_solution(WANTED_PARTS, s['allocation'], stores)
+
+
+def test_reoptimize():
+  try:
+    import pulp
+  except ImportError:
+    raise SkipTest('PuLP is not installed')
+
+  previous = ilp(WANTED_PARTS, JUST_RIGHT, STORES, solver='cbc')[0]
+
+  # nothing new and everything bought is still there
+  delta = pricing.diff(JUST_RIGHT, JUST_RIGHT)
+  solution = reoptimize(WANTED_PARTS, previous, JUST_RIGHT, STORES, delta=delta, solver='cbc')[0]
+  assert solution['warm_start'] == 'unchanged'
+  assert abs(solution['cost'] - previous['cost']) < 1e-6
+
+  # store 'one' restocked, so store 'two' isn't needed anymore
+  price_guide = JUST_RIGHT + [dict(JUST_RIGHT[1], quantity_available=20)]
+  delta = pricing.diff(JUST_RIGHT, price_guide)
+  solution = reoptimize(WANTED_PARTS, previous, price_guide, STORES, delta=delta, solver='cbc')[0]
+  assert solution['warm_start'] == 'repaired'
+  assert solution['store_ids'] == ['one']
+  assert is_valid_solution(WANTED_PARTS, solution['allocation'], STORES)
+
+
+def test_repair():
+  allocation = [dict(lot, quantity=lot['quantity_available']) for lot in JUST_RIGHT]
+  allocation[0]['quantity'] = 100
+  guide = pricing.PriceGuide.from_lots(JUST_RIGHT)
+  quantities, changed = repair(WANTED_PARTS, allocation, guide, STORES)
+  assert not changed
+  assert quantities.tolist() == [100, 30, 25, 10]
+
+  # the lot from store 'two' sold out, but there's more elsewhere
+  price_guide = JUST_RIGHT[:2] + JUST_RIGHT[3:] + [dict(JUST_RIGHT[1], cost_per_unit=0.50)]
+  guide = pricing.PriceGuide.from_lots(price_guide)
+  quantities, changed = repair(WANTED_PARTS, allocation, guide, STORES)
+  assert changed
+  assert quantities.tolist() == [100, 30, 10, 20]
+
+  # nobody has enough anymore
+  quantities, changed = repair(WANTED_PARTS, allocation, NOT_ENOUGH_INVENTORY, STORES)
+  assert quantities is None
+
+
+def test_ilp_model():
+  model = ilp_model(WANTED_PARTS, JUST_RIGHT, STORES, shipping_cost=10.0)
+  # stores are sorted by id
+  assert model['store_ids'] == ['one', 'two']
+  assert model['objective'].tolist() == [10.0, 10.0, 0.05, 0.10, 0.25, 0.20]
+  assert model['integer'].tolist() == [True, True, False, False, False, False]
+
+  rows = list(ilp_rows(model))
+  assert len(rows) == len(JUST_RIGHT) + len(WANTED_PARTS) + len(STORES)
+
+  # quantity bought of the first lot <= 120 * use store 'one'
+  assert rows[0] == ([2, 0], [1.0, -120.0], -INFINITY, 0.0)
+
+  # wanted amount of item 123 in color 2
+  assert rows[5] == ([3, 4], [1.0, 1.0], 50.0, INFINITY)
+
+  # minimum buy of store 'two'
+  assert rows[-1] == ([4, 1], [0.25, -0.0], 0.0, INFINITY)
+
+  assert ilp_model(WANTED_PARTS, MISSING_PART, STORES) is None
+
+
+def test_presolve():
+  wanted = [{'ItemID': '1', 'ColorID': 1, 'Qty': 10, 'ItemName': 'Item1'}]
+  lot = lambda store_id, quantity, price, item_id='1': {
+    'item_id': item_id, 'wanted_color_id': 1, 'color_id': 1,
+    'store_id': store_id, 'quantity_available': quantity, 'cost_per_unit': price
+  }
+  price_guide = [
+    lot(1, 10, 0.10),
+    lot(1, 5, 0.50),              # store 1 has enough for less
+    lot(1, 5, 0.10, item_id='2'), # nobody wants item 2
+    lot(2, 10, 0.20),             # store 1 sells enough for less
+    lot(3, 10, 0.05),             # can't reach minimum buy
+    lot(4, 10, 0.01),
+    lot(4, 10, 0.02),             # store 4 has a minimum buy, so keep it
+  ]
+  stores = [
+    {'store_id': 1, 'minimum_buy': 0.0},
+    {'store_id': 2, 'minimum_buy': 0.0},
+    {'store_id': 3, 'minimum_buy': 1.0},
+    {'store_id': 4, 'minimum_buy': 0.25},
+  ]
+  kept, kept_stores, report = presolve(wanted, price_guide, stores)
+
+  assert kept == [price_guide[0], price_guide[5], price_guide[6]]
+  assert [s['store_id'] for s in kept_stores] == [1, 4]
+  assert report['unwanted_lots'] == 1
+  assert report['excess_lots'] == 1
+  assert report['unreachable_minimum_buy'] == [3]
+  assert report['dominated_stores'] == {2: 1}
+  assert report['lots_removed'] == 4
+  assert report['stores_removed'] == 2
+
+  # without store metadata nobody has a minimum buy, so store 4 is the only
+  # one worth buying from
+  kept, kept_stores, report = presolve(wanted, price_guide, None)
+  assert kept_stores is None
+  assert kept == [price_guide[5]]
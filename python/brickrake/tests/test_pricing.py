@@ -0,0 +1,70 @@
+"""
+Tests for brickrake.pricing
+"""
+from brickrake.pricing import *
+
+
+lot = lambda store_id, item_id, quantity, price: {
+  'item_id': item_id, 'wanted_color_id': 1, 'color_id': 1,
+  'store_id': store_id, 'quantity_available': quantity, 'cost_per_unit': price
+}
+
+LOTS = [
+  lot('b', '1', 10, 0.30),
+  lot('a', '1', 5, 0.10),
+  lot('b', '2', 7, 0.20),
+  lot('b', '1', 3, 0.05),
+  lot('a', '1', 1, 0.10),
+]
+
+
+def test_from_lots():
+  guide = PriceGuide.from_lots(LOTS)
+  assert len(guide) == 5
+  assert guide.lots() == LOTS
+  assert sorted(guide.store_ids) == ['a', 'b']
+  assert guide.store_index('c') == -1
+
+  wanted = [{'ItemID': '2', 'ColorID': 1}, {'ItemID': '3', 'ColorID': 1}]
+  assert guide.wanted_items(wanted).tolist() == [guide.items.index(('2', 1)), -1]
+
+
+def test_groups():
+  guide = PriceGuide.from_lots(LOTS)
+
+  # lots of item 1, cheapest first. Ties go to the lot that comes last.
+  k = guide.items.index(('1', 1))
+  assert guide.item_lots[guide.item_offsets[k]:guide.item_offsets[k + 1]].tolist() == [3, 4, 1, 0]
+
+  # store b sells 13 of item 1 and 7 of item 2
+  s = guide.store_index('b')
+  pairs = range(guide.store_pair_offsets[s], guide.store_pair_offsets[s + 1])
+  sells = [(guide.items[guide.pair_item[p]][0], guide.pair_quantity[p]) for p in pairs]
+  assert sorted(sells) == [('1', 13), ('2', 7)]
+  assert sorted(guide.store_lots[guide.store_offsets[s]:guide.store_offsets[s + 1]].tolist()) == [0, 2, 3]
+
+
+def test_select_stores():
+  guide = PriceGuide.from_lots(LOTS).select_stores(['a'])
+  assert guide.store_ids == ['a']
+  assert guide.lots() == [LOTS[1], LOTS[4]]
+  assert guide.item_offsets.tolist() == [0, 2, 2]
+
+
+def test_diff():
+  new = [dict(e) for e in LOTS[1:]]
+  new[0]['quantity_available'] = 8     # was 5
+  new[1]['cost_per_unit'] = 0.15       # was 0.20
+  new.append(lot('c', '1', 2, 0.01))
+
+  delta = diff(LOTS, new)
+  assert sorted((e['store_id'], e['item_id'], e['quantity_available'], e['cost_per_unit'])
+                for e in delta['added']) == [
+    ('a', '1', 3, 0.10), ('b', '2', 7, 0.15), ('c', '1', 2, 0.01)
+  ]
+  assert sorted((e['store_id'], e['item_id'], e['quantity_available'], e['cost_per_unit'])
+                for e in delta['removed']) == [
+    ('b', '1', 10, 0.30), ('b', '2', 7, 0.20)
+  ]
+
+  assert diff(LOTS, PriceGuide.from_lots(LOTS)) == {'added': [], 'removed': []}
@@ -0,0 +1,270 @@
+"""
+Tests for brickrake.scraper
+"""
+import json
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.pool import ThreadPool
+
+from brickrake import color
+from brickrake import scraper
+from brickrake import utils
+
+
+# inventory served for item '3001', by color id
+INVENTORY = {
+  1: [(101, 6, 0.10), (102, 4, 0.12)],
+  123: [(103, 5, 0.08)],
+  12: [(104, 50, 0.30)],
+}
+
+WANTED = {
+  'ItemID': '3001',
+  'ItemTypeID': 'P',
+  'ColorID': 1,
+  'Qty': 15,
+}
+
+
+def catalog_page(lots):
+  """A page shaped like catalogPG.asp"""
+  if len(lots) == 0:
+    return '<html><body><table><tr><td>No Items</td></tr></table></body></html>'
+  rows = "".join(
+      '<tr><td><a href="/store.asp?sID=%d&itemID=3001">Store</a></td>'
+      '<td>%d</td><td>US $%.2f</td></tr>' % lot
+      for lot in lots
+  )
+  return ('<html><body><table><tr><td><b>Currently Available</b></td></tr>'
+          + rows + '</table></body></html>')
+
+
+class CatalogHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    params = utils.get_params(self.path)
+    self.server.requests.append(int(params['colorId']))
+    page = catalog_page(INVENTORY.get(int(params['colorId']), []))
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html')
+    self.end_headers()
+    self.wfile.write(page)
+
+  def log_message(self, *args):
+    pass
+
+
+def serve(handler=CatalogHandler):
+  server = HTTPServer(('127.0.0.1', 0), handler)
+  server.requests = []
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def test_price_guide():
+  server = serve()
+  old_url = scraper.BASE_URL
+  scraper.BASE_URL = 'http://127.0.0.1:%d' % server.server_port
+  try:
+    serial = scraper.price_guide(WANTED)
+
+    # the three colors closest to white are the only ones fetched
+    assert server.requests == [1, 83, 123]
+    assert [e['store_id'] for e in serial] == [101, 102, 103]
+    assert all(e['wanted_color_id'] == 1 for e in serial)
+
+    # fetching concurrently gives the same answer
+    pool = ThreadPool(4)
+    for batch_size in [1, 2, 4]:
+      assert scraper.price_guide(WANTED, pool=pool, batch_size=batch_size) == serial
+
+    # so does parsing pages with Beautiful Soup
+    assert scraper.price_guide(WANTED, parser='bs4') == serial
+
+    # colors searched are counted, and can be limited
+    stats = {}
+    scraper.price_guide(WANTED, stats=stats)
+    assert stats == {'tried': 3, 'used': 2}
+
+    del server.requests[:]
+    assert [e['store_id'] for e in scraper.price_guide(WANTED, max_colors=2)] == [101, 102]
+    assert server.requests == [1, 83]
+
+    # the wanted color is searched first, even if other colors are identical
+    del server.requests[:]
+    tied = scraper.price_guide(dict(WANTED, ColorID=123), max_colors=1)
+    assert server.requests == [123]
+    assert [e['store_id'] for e in tied] == [103]
+
+    del server.requests[:]
+    far = scraper.price_guide(dict(WANTED, Qty=100), max_distance=5.0)
+    assert sorted(e['color_id'] for e in far) == [1, 1, 12, 123]
+    assert all(d <= 5.0 for (c, d) in color.neighbors(1) if c in server.requests)
+    pool.close()
+  finally:
+    scraper.BASE_URL = old_url
+    server.shutdown()
+
+
+# catalogPG.asp pages, and the lots on each. The pages checked in are written
+# by hand after BrickLink's markup. Pages saved from BrickLink can be added
+# without a .json, in which case every parser must agree with Beautiful Soup.
+CATALOG_PAGES = os.path.join(os.path.dirname(__file__), 'data', 'catalog_pg')
+
+
+def test_parse_price_guide():
+  pages = [name for name in sorted(os.listdir(CATALOG_PAGES)) if name.endswith('.html')]
+  assert len(pages) > 0
+  for name in pages:
+    with open(os.path.join(CATALOG_PAGES, name)) as f:
+      html = f.read()
+    lots_path = os.path.join(CATALOG_PAGES, name[:-len('.html')] + '.json')
+    if os.path.exists(lots_path):
+      with open(lots_path) as f:
+        expected = json.load(f)
+      if expected is not None:
+        expected = [tuple(lot) for lot in expected]
+    else:
+      expected = scraper.parse_price_guide(html, 'bs4')
+
+    for parser in scraper.PARSERS:
+      assert scraper.parse_price_guide(html, parser) == expected, (name, parser)
+
+
+# stores served, by country id
+STORES = {
+  'US': [('alice', 1, 0.0), ('bob', 2, 10.0)],
+  'DE': [('carol', 3, None), ('dave', 4, 0.0)],
+}
+
+
+def store_page(path):
+  """Pages shaped like those store_info crawls"""
+  params = utils.get_params(path)
+  if path.startswith('/browse.asp'):
+    links = ''.join('<a href="/browseStores.asp?countryID=%s">%s</a>' % (c, c) for c in sorted(STORES))
+    return '<html><body><table><tr><td><b>Stores:</b></td><td>%s</td></tr></table></body></html>' % links
+  if path.startswith('/browseStores.asp'):
+    links = ''.join('<a href="store.asp?p=%s">%s</a>' % (name, name)
+                    for (name, id, min_buy) in STORES[params['countryID']])
+    return '<html><body>%s</body></html>' % links
+
+  stores = dict((name, (country, id, min_buy))
+                for (country, lst) in STORES.items() for (name, id, min_buy) in lst)
+  if path.startswith('/store.asp'):
+    (country, id, min_buy) = stores[params['p']]
+    return ('<html><frameset><frame src="storeTop.asp?uID=%d&storeName=%s&cn=%s&c=%s'
+            '&p_seller=%s&p_feedback=%d"></frameset></html>'
+            % (id, params['p'].title(), country, country, params['p'], 10 * id))
+  if path.startswith('/storeSplash.asp'):
+    (country, id, min_buy) = [v for v in stores.values() if v[1] == int(params['uID'])][0]
+    if min_buy == 0.0:
+      return '<html><body></body></html>'
+    amount = 'US $%.2f' % min_buy if min_buy is not None else 'EUR 5.00'
+    return ('<html><body><table><tr><td><font><b>Minimum Buy:</b></font></td></tr>'
+            '<tr><td><font>%s</font></td></tr></table></body></html>' % amount)
+
+
+class StoreHandler(BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    self.server.requests.append(self.path)
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html')
+    self.end_headers()
+    self.wfile.write(store_page(self.path))
+
+  def log_message(self, *args):
+    pass
+
+
+def test_store_info():
+  server = serve(StoreHandler)
+  old_url = scraper.BASE_URL
+  scraper.BASE_URL = 'http://127.0.0.1:%d' % server.server_port
+  try:
+    serial = scraper.store_info()
+
+    # carol's minimum buy isn't in US dollars
+    assert [s['seller_name'] for s in serial] == ['carol', 'dave', 'alice', 'bob']
+    assert [s['minimum_buy'] for s in serial] == [None, 0.0, 0.0, 10.0]
+
+    pool = ThreadPool(4)
+    by_seller = lambda stores: sorted((s['seller_name'], s['store_id'], s['minimum_buy']) for s in stores)
+    assert by_seller(scraper.store_info(pool=pool)) == by_seller(serial)
+
+    # stores already found aren't fetched again
+    del server.requests[:]
+    assert [s['seller_name'] for s in scraper.store_info(country='US', pool=pool, skip=['alice'])] == ['bob']
+    assert not any('alice' in path for path in server.requests)
+
+    # stores with a foreign currency minimum buy are skipped too
+    del server.requests[:]
+    assert [s['seller_name'] for s in scraper.store_info(country='DE', pool=pool, skip=['carol'])] == ['dave']
+    assert not any('carol' in path for path in server.requests)
+    pool.close()
+
+    # a store can't be skipped without knowing its seller name
+    old_country_store_urls = scraper.country_store_urls
+    scraper.country_store_urls = lambda country_url: ['store.asp?uID=1']
+    try:
+      scraper.store_info(country='US')
+      assert False, 'store link without a seller name was accepted'
+    except ValueError:
+      pass
+    finally:
+      scraper.country_store_urls = old_country_store_urls
+  finally:
+    scraper.BASE_URL = old_url
+    server.shutdown()
+
+
+def test_update_store_info():
+  server = serve(StoreHandler)
+  old_url = scraper.BASE_URL
+  scraper.BASE_URL = 'http://127.0.0.1:%d' % server.server_port
+  try:
+    stores = dict((s['seller_name'], s) for s in scraper.store_info())
+    stores['alice']['fetched_at'] = time.time() - 100
+    stores['dave']['fetched_at'] = time.time() - 100
+    stores['bob']['fetched_at'] = time.time() - 100000
+    stores['erin'] = dict(stores['bob'], seller_name='erin', store_id=5)
+
+    # alice and dave are fresh, bob is stale and erin is gone
+    del server.requests[:]
+    updated = list(scraper.update_store_info(stores.values(), ttl=1000))
+    assert [(s['seller_name'], fetched) for (s, fetched) in updated[:1]] == [('bob', True)]
+    assert sorted((s['seller_name'], fetched) for (s, fetched) in updated[1:]) == [
+      ('alice', False), ('carol', False), ('dave', False)
+    ]
+    assert updated[0][0]['fetched_at'] > stores['bob']['fetched_at']
+    assert not any('alice' in path or 'carol' in path or 'dave' in path for path in server.requests)
+
+    # only stores from the country being updated can be dropped
+    updated = list(scraper.update_store_info(stores.values(), ttl=1000, country='US'))
+    assert sorted(s['seller_name'] for (s, fetched) in updated) == ['alice', 'bob', 'carol', 'dave']
+
+    # stores from other countries are kept even when they're stale
+    stores['dave']['fetched_at'] = time.time() - 100000
+    del server.requests[:]
+    updated = list(scraper.update_store_info(stores.values(), ttl=1000, country='US'))
+    assert sorted(s['seller_name'] for (s, fetched) in updated) == ['alice', 'bob', 'carol', 'dave']
+    assert [(s, fetched) for (s, fetched) in updated if s['seller_name'] == 'dave'] == [
+      (stores['dave'], False)
+    ]
+    assert not any('dave' in path for path in server.requests)
+
+    # store lists saved before fetch times were recorded
+    old_stores = [dict((k, v) for (k, v) in s.items() if k != 'fetched_at')
+                  for s in stores.values()]
+    updated = list(scraper.update_store_info(old_stores, ttl=1000, country='US'))
+    assert sorted((s['seller_name'], fetched) for (s, fetched) in updated) == [
+      ('alice', True), ('bob', True), ('carol', False), ('dave', False)
+    ]
+  finally:
+    scraper.BASE_URL = old_url
+    server.shutdown()
@@ -3,15 +3,21 @@ Utility methods
 """
 import itertools
 import math
-import urllib
 import urlparse
 
-from bs4 import BeautifulSoup as BS
+import web
+
+
+# parser Beautiful Soup uses. Named so pages are parsed the same way whatever
+# else is installed.
+HTML_PARSER = 'html.parser'
 
 
 def beautiful_soup(url):
   """Fetch a web page and return its contents as parsed by Beautiful Soup"""
-  return BS(urllib.urlopen(url).read())
+  from bs4 import BeautifulSoup as BS
+
+  return BS(web.fetch(url), HTML_PARSER)
 
 
 def get_params(url):
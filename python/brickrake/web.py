@@ -0,0 +1,292 @@
+"""
+Functions for fetching pages from bricklink.com
+"""
+import base64
+import httplib
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+
+class Throttle(object):
+  """Limit the number of concurrent requests and the request rate per host
+
+  Parameters
+  ----------
+  max_concurrent : int
+      maximum number of requests in flight to the same host
+  min_interval : float
+      minimum number of seconds between the start of two requests to the
+      same host
+  """
+
+  def __init__(self, max_concurrent=4, min_interval=0.0):
+    self.max_concurrent = max_concurrent
+    self.min_interval = min_interval
+    self._lock = threading.Lock()
+    self._semaphores = {}
+    self._last_request = {}
+
+  def _semaphore(self, host):
+    with self._lock:
+      if host not in self._semaphores:
+        self._semaphores[host] = threading.BoundedSemaphore(self.max_concurrent)
+      return self._semaphores[host]
+
+  def _wait_turn(self, host):
+    # reserve the next start time for this host, then sleep until it arrives
+    with self._lock:
+      now = time.time()
+      start = max(now, self._last_request.get(host, 0.0) + self.min_interval)
+      self._last_request[host] = start
+    if start > now:
+      time.sleep(start - now)
+
+  def __call__(self, url, fetch):
+    host = urlparse.urlparse(url).netloc
+    semaphore = self._semaphore(host)
+    with semaphore:
+      self._wait_turn(host)
+      return fetch(url)
+
+
+# shared by every request made through this module
+THROTTLE = Throttle()
+
+
+def set_throttle(max_concurrent=4, min_interval=0.0):
+  """Change the per-host concurrency and rate cap for all requests"""
+  global THROTTLE
+  THROTTLE = Throttle(max_concurrent, min_interval)
+
+
+class Session(object):
+  """Fetch pages over persistent connections, with compressed transfers
+
+  Each thread keeps one connection open per host and reuses it for every
+  request to that host. Proxies are taken from the environment (http_proxy,
+  https_proxy and no_proxy), like urllib does.
+
+  Parameters
+  ----------
+  timeout : float or None
+      seconds to wait for a server to accept a connection or send data
+  max_redirects : int
+      maximum number of redirects to follow for a single page
+  """
+
+  def __init__(self, timeout=30.0, max_redirects=5):
+    self.timeout = timeout
+    self.max_redirects = max_redirects
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.connections = 0
+    self.reused = 0
+    self.bytes_received = 0
+    self.bytes_decoded = 0
+
+  def _connections(self):
+    if not hasattr(self._local, 'connections'):
+      self._local.connections = {}
+    return self._local.connections
+
+  def _count(self, **counts):
+    with self._lock:
+      for (name, n) in counts.iteritems():
+        setattr(self, name, getattr(self, name) + n)
+
+  def get(self, url):
+    """Contents of a web page, following redirects"""
+    return self.open(url)[1]
+
+  def open(self, url):
+    """(HTTP status, contents) of a web page, following redirects
+
+    Raises IOError if the server is overloaded or asks to slow down (HTTP 429
+    and 5xx), as it's worth trying again later.
+    """
+    for i in range(self.max_redirects + 1):
+      (status, headers, content) = self._request(url)
+      if status in (301, 302, 303, 307) and headers.get('location') is not None:
+        url = urlparse.urljoin(url, headers['location'])
+        continue
+      if status == 429 or status >= 500:
+        raise IOError('HTTP %d for %s' % (status, url))
+      return (status, content)
+    raise IOError('Too many redirects for %s' % (url,))
+
+  def _request(self, url):
+    parsed = urlparse.urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+    path = parsed.path or '/'
+    if parsed.query:
+      path += '?' + parsed.query
+
+    connections = self._connections()
+    reused = key in connections
+    if not reused:
+      connections[key] = self._connect(parsed)
+
+    try:
+      response = self._send(connections[key], url, path)
+    except (IOError, httplib.HTTPException):
+      # the server may have closed an idle connection. Try a fresh one once.
+      connections.pop(key).close()
+      if not reused:
+        raise
+      reused = False
+      connections[key] = self._connect(parsed)
+      response = self._send(connections[key], url, path)
+
+    content = response.read()
+    if response.will_close:
+      connections.pop(key).close()
+
+    received = len(content)
+    encoding = (response.getheader('content-encoding') or '').lower()
+    if encoding == 'gzip':
+      content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+      try:
+        content = zlib.decompress(content)
+      except zlib.error:
+        # some servers send deflate without the zlib header
+        content = zlib.decompress(content, -zlib.MAX_WBITS)
+
+    self._count(requests=1, reused=int(reused), bytes_received=received,
+                bytes_decoded=len(content))
+    return (response.status, dict(response.getheaders()), content)
+
+  def _connect(self, parsed):
+    self._count(connections=1)
+    connection_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+
+    proxy = self._proxy(parsed)
+    if proxy is None:
+      connection = connection_class(parsed.netloc, timeout=self.timeout)
+      connection.proxy_headers = None
+      return connection
+
+    (netloc, headers) = proxy
+    if parsed.scheme == 'https':
+      # tunnel through the proxy, then talk to the server as usual
+      connection = connection_class(netloc, timeout=self.timeout)
+      connection.set_tunnel(parsed.netloc, headers=headers)
+      connection.proxy_headers = None
+    else:
+      # ask the proxy for the whole URL
+      connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+      connection.proxy_headers = headers
+    return connection
+
+  def _proxy(self, parsed):
+    """(proxy host:port, headers to send it) for a URL, or None"""
+    proxy = urllib.getproxies().get(parsed.scheme)
+    if proxy is None or urllib.proxy_bypass(parsed.hostname):
+      return None
+    if '://' not in proxy:
+      proxy = 'http://' + proxy
+    proxy = urlparse.urlparse(proxy)
+
+    headers = {}
+    if proxy.username is not None:
+      credentials = '%s:%s' % (urllib.unquote(proxy.username), urllib.unquote(proxy.password or ''))
+      headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+    netloc = proxy.hostname + (':%d' % proxy.port if proxy.port is not None else '')
+    return (netloc, headers)
+
+  def _send(self, connection, url, path):
+    headers = {
+      'Accept-Encoding': 'gzip, deflate',
+      'Connection': 'keep-alive',
+    }
+    if connection.proxy_headers is not None:
+      headers.update(connection.proxy_headers)
+      path = url
+    connection.request('GET', path, headers=headers)
+    return connection.getresponse()
+
+  def close(self):
+    """Close the connections opened by the current thread"""
+    connections = self._connections()
+    while len(connections) > 0:
+      connections.popitem()[1].close()
+
+  def stats(self):
+    """Counters describing the traffic of every request so far"""
+    with self._lock:
+      return {
+        'requests': self.requests,
+        'connections': self.connections,
+        'reused': self.reused,
+        'bytes_received': self.bytes_received,
+        'bytes_decoded': self.bytes_decoded,
+      }
+
+
+# shared by every request made through this module
+SESSION = Session()
+
+
+def set_session(timeout=30.0):
+  """Start a new session with its own connections and counters"""
+  global SESSION
+  SESSION = Session(timeout)
+
+
+# how many times to retry a failed request, and how long to wait before the
+# first retry. The wait doubles after every failure.
+RETRIES = 0
+BACKOFF = 1.0
+
+
+def set_retries(retries=0, backoff=1.0):
+  """Change how failed requests are retried for all requests"""
+  global RETRIES, BACKOFF
+  RETRIES = retries
+  BACKOFF = backoff
+
+
+# optional brickrake.cache.ResponseCache consulted before every request
+CACHE = None
+
+
+def set_cache(cache):
+  """Use a response cache for all requests. Pass None to stop caching."""
+  global CACHE
+  CACHE = cache
+
+
+def fetch(url):
+  """Fetch the contents of a web page, respecting the per-host throttle"""
+  cache = CACHE
+  if cache is not None:
+    content = cache.get(url)
+    if content is not None:
+      return content
+
+  (status, content) = download(url)
+
+  # error pages, like a 404, are returned but not kept
+  if cache is not None and 200 <= status < 300:
+    cache.put(url, content)
+  return content
+
+
+def download(url):
+  """(HTTP status, contents) of a web page, retrying with exponential backoff
+  if it fails
+
+  Every attempt waits its turn with the throttle, and the wait between
+  attempts doesn't hold up other requests to the same host.
+  """
+  for attempt in range(RETRIES + 1):
+    try:
+      return THROTTLE(url, SESSION.open)
+    except (IOError, httplib.HTTPException):
+      if attempt == RETRIES:
+        raise
+      time.sleep(BACKOFF * 2 ** attempt)